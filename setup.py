@@ -23,9 +23,14 @@ setup(
       'pytest',
       'pandas==0.24.1',
       'scikit-learn==0.20.2',
+      'scipy',
       'matplotlib==3.0.2'
   ],
 
+  extras_require={
+      'columnar': ['pyarrow'],
+  },
+
   package_data={
       '': ['*.yaml'],
   },
@@ -4,7 +4,14 @@ import os
 import numpy as np
 import pandas as pd
 import hashlib
+import itertools
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from tokens import UNKNOWN_ID, TokenDictionary, shared_tokens
+from cache import DEFAULT_CACHE_SIZE, MatchCache
+from output import DEFAULT_ROW_GROUP_SIZE, write_columnar
 
 try:
     # Python 2
@@ -14,16 +21,93 @@ except NameError:
     xrange = range
 
 
+# smaller leaves are cheaper to score token by token than through numpy
+VECTOR_MIN_CLUSTERS = 4
+
+
 class Logcluster:
+    __slots__ = ('logTemplate', 'logIDL', 'level', 'bucket', 'bucketRow')
+
     def __init__(self, level, logTemplate='', logIDL=None):
         self.logTemplate = logTemplate
-        if logIDL is None:
-            logIDL = []
-        self.logIDL = logIDL
+        self.logIDL = array('l') if logIDL is None else array('l', logIDL)
         self.level = level
+        # leaf bucket holding the cluster and its row there
+        self.bucket = None
+        self.bucketRow = None
+
+    def __getstate__(self):
+        # line ids belong to the run that assigned them and are not checkpointed
+        return (self.logTemplate, self.level, self.bucket, self.bucketRow)
+
+    def __setstate__(self, state):
+        self.logTemplate, self.level, self.bucket, self.bucketRow = state
+        self.logIDL = array('l')
+
+
+class ClusterBucket:
+    """ Log clusters of a leaf node. The templates are kept as rows of a
+    token id matrix so that a sequence is scored against all of them at once.
+    """
+    __slots__ = ('wildcard', 'clusters', 'templates', 'numOfPar')
+
+    def __init__(self, seqLen, wildcard, capacity=4):
+        self.wildcard = wildcard
+        self.clusters = []
+        self.templates = np.empty((capacity, seqLen), dtype=np.int32)
+        self.numOfPar = np.empty(capacity, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.clusters)
+
+    def __iter__(self):
+        return iter(self.clusters)
+
+    def append(self, logClust, templateIds):
+        row = len(self.clusters)
+        if row == len(self.templates):
+            self.templates = np.concatenate((self.templates, np.empty_like(self.templates)))
+            self.numOfPar = np.concatenate((self.numOfPar, np.empty_like(self.numOfPar)))
+        self.clusters.append(logClust)
+        logClust.bucket = self
+        logClust.bucketRow = row
+        self.update(row, templateIds)
+
+    def update(self, row, templateIds):
+        self.templates[row] = templateIds
+        self.numOfPar[row] = np.count_nonzero(self.templates[row] == self.wildcard)
+
+    def scores(self, seqIds):
+        """ Number of similar tokens and of parameters of every template,
+        seqIds must not contain the wildcard id
+        """
+        size = len(self.clusters)
+        simTokens = (self.templates[:size] == seqIds).sum(axis=1)
+        return simTokens, self.numOfPar[:size]
+
+    def bestMatch(self, seqIds):
+        """ Row with the most similar tokens, ties going to the most parameters
+        and then to the first row, like seqDist in a loop; with its similar tokens
+        """
+        simTokens, numOfPar = self.scores(seqIds)
+        if len(simTokens) == 1:
+            return 0, int(simTokens[0])
+        row = int((simTokens * (self.templates.shape[1] + 1) + numOfPar).argmax())
+        return row, int(simTokens[row])
+
+    def bestMatchBatch(self, seqIdsMatrix):
+        """ bestMatch for every row of a (messages x seqLen) matrix
+        """
+        size = len(self.clusters)
+        simTokens = (self.templates[None, :size, :] == seqIdsMatrix[:, None, :]).sum(axis=2)
+        keys = simTokens * (self.templates.shape[1] + 1) + self.numOfPar[None, :size]
+        rows = np.argmax(keys, axis=1)
+        return rows, simTokens[np.arange(len(rows)), rows]
 
 
 class Node:
+    __slots__ = ('childD', 'depth', 'digitOrtoken')
+
     def __init__(self, childD=None, depth=0, digitOrtoken=None):
         if childD is None:
             childD = dict()
@@ -33,7 +117,8 @@ class Node:
 
 
 class LogParser:
-    def __init__(self, outdir='./result/', depth=4, st=0.4, maxChild=100):
+    def __init__(self, outdir='./result/', depth=4, st=0.4, maxChild=100, tokens=None, workers=1,
+                 cacheSize=DEFAULT_CACHE_SIZE):
         """
         Attributes
         ----------
@@ -44,6 +129,9 @@ class LogParser:
             maxChild : max number of children of an internal node
             logName : the name of the input file containing raw log messages
             savePath : the output path stores the file containing structured logs
+            tokens : token dictionary the templates are encoded with
+            workers : number of processes the message lengths are parsed in
+            cacheSize : messages remembered by the match cache, 0 disables it
         """
         self.depth = depth - 2
         self.st = st
@@ -52,6 +140,25 @@ class LogParser:
         self.df_log = None
         self.rootNode = Node()
         self.logCluL = []
+        if tokens is None:
+            tokens = shared_tokens
+        self.tokens = tokens
+        self.wildcard = tokens.encode_token('<*>')
+        self.workers = workers
+        self.cache = MatchCache(cacheSize) if cacheSize > 0 else None
+        # message length -> version of its subtree, bumped on every change
+        self.versions = dict()
+        # cluster of the message add_log was called with last
+        self.lastCluster = None
+
+    def seqIds(self, seq):
+        """ Token ids of a message as an array for the leaf buckets, a literal
+        '<*>' in the message never counts as similar so it becomes UNKNOWN_ID
+        """
+        seqIds = np.array(seq, dtype=np.int32)
+        if self.wildcard in seq:
+            seqIds[seqIds == self.wildcard] = UNKNOWN_ID
+        return seqIds
 
     def hasNumbers(self, s):
         return any(char.isdigit() for char in s)
@@ -72,8 +179,8 @@ class LogParser:
 
             if token in parentn.childD:
                 parentn = parentn.childD[token]
-            elif '<*>' in parentn.childD:
-                parentn = parentn.childD['<*>']
+            elif self.wildcard in parentn.childD:
+                parentn = parentn.childD[self.wildcard]
             else:
                 return retLogClust
             currentDepth += 1
@@ -100,40 +207,39 @@ class LogParser:
             #Add current log cluster to the leaf node
             if currentDepth >= self.depth or currentDepth > seqLen:
                 if len(parentn.childD) == 0:
-                    parentn.childD = [logClust]
-                else:
-                    parentn.childD.append(logClust)
+                    parentn.childD = ClusterBucket(seqLen, self.wildcard)
+                parentn.childD.append(logClust, logClust.logTemplate)
                 break
 
             #If token not matched in this layer of existing tree.
             if token not in parentn.childD:
-                if not self.hasNumbers(token):
-                    if '<*>' in parentn.childD:
+                if not self.hasNumbers(self.tokens.decode_token(token)):
+                    if self.wildcard in parentn.childD:
                         if len(parentn.childD) < self.maxChild:
                             newNode = Node(depth=currentDepth + 1, digitOrtoken=token)
                             parentn.childD[token] = newNode
                             parentn = newNode
                         else:
-                            parentn = parentn.childD['<*>']
+                            parentn = parentn.childD[self.wildcard]
                     else:
                         if len(parentn.childD)+1 < self.maxChild:
                             newNode = Node(depth=currentDepth+1, digitOrtoken=token)
                             parentn.childD[token] = newNode
                             parentn = newNode
                         elif len(parentn.childD)+1 == self.maxChild:
-                            newNode = Node(depth=currentDepth+1, digitOrtoken='<*>')
-                            parentn.childD['<*>'] = newNode
+                            newNode = Node(depth=currentDepth+1, digitOrtoken=self.wildcard)
+                            parentn.childD[self.wildcard] = newNode
                             parentn = newNode
                         else:
-                            parentn = parentn.childD['<*>']
+                            parentn = parentn.childD[self.wildcard]
 
                 else:
-                    if '<*>' not in parentn.childD:
-                        newNode = Node(depth=currentDepth+1, digitOrtoken='<*>')
-                        parentn.childD['<*>'] = newNode
+                    if self.wildcard not in parentn.childD:
+                        newNode = Node(depth=currentDepth+1, digitOrtoken=self.wildcard)
+                        parentn.childD[self.wildcard] = newNode
                         parentn = newNode
                     else:
-                        parentn = parentn.childD['<*>']
+                        parentn = parentn.childD[self.wildcard]
 
             #If the token is matched
             else:
@@ -148,7 +254,7 @@ class LogParser:
         numOfPar = 0
 
         for token1, token2 in zip(seq1, seq2):
-            if token1 == '<*>':
+            if token1 == self.wildcard:
                 numOfPar += 1
                 continue
             if token1 == token2:
@@ -166,18 +272,35 @@ class LogParser:
         maxNumOfPara = -1
         maxClust = None
 
-        for logClust in logClustL:
-            curSim, curNumOfPara = self.seqDist(logClust.logTemplate, seq)
-            if curSim>maxSim or (curSim==maxSim and curNumOfPara>maxNumOfPara):
-                maxSim = curSim
-                maxNumOfPara = curNumOfPara
-                maxClust = logClust
+        if len(logClustL) < VECTOR_MIN_CLUSTERS:
+            for logClust in logClustL:
+                curSim, curNumOfPara = self.seqDist(logClust.logTemplate, seq)
+                if curSim>maxSim or (curSim==maxSim and curNumOfPara>maxNumOfPara):
+                    maxSim = curSim
+                    maxNumOfPara = curNumOfPara
+                    maxClust = logClust
+        else:
+            row, simTokens = logClustL.bestMatch(self.seqIds(seq))
+            maxSim = float(simTokens) / len(seq)
+            maxClust = logClustL.clusters[row]
 
         if maxSim >= self.st:
             retLogClust = maxClust
 
         return retLogClust
 
+    def fastMatchBatch(self, logClustL, seqs):
+        """ fastMatch of many sequences of the leaf's length at once
+        """
+        if len(logClustL) == 0:
+            return [None] * len(seqs)
+
+        seqIdsMatrix = np.array([self.seqIds(seq) for seq in seqs], dtype=np.int32)
+        rows, simTokens = logClustL.bestMatchBatch(seqIdsMatrix)
+        seqLen = seqIdsMatrix.shape[1]
+        return [logClustL.clusters[row] if float(sim) / seqLen >= self.st else None
+                for row, sim in zip(rows, simTokens)]
+
     def getTemplate(self, seq1, seq2):
         assert len(seq1) == len(seq2)
         retVal = []
@@ -187,11 +310,11 @@ class LogParser:
             if word == seq2[i]:
                 retVal.append(word)
             else:
-                retVal.append('<*>')
+                retVal.append(self.wildcard)
 
             i += 1
 
-        return retVal
+        return array('i', retVal)
 
     def outputResult(self, df_log, logClustL, logname):
         if not os.path.exists(self.savePath):
@@ -202,7 +325,7 @@ class LogParser:
         log_templatelevels = [0] * df_log.shape[0]
         df_events = []
         for logClust in logClustL:
-            template_str = ' '.join(logClust.logTemplate)
+            template_str = ' '.join(self.tokens.decode(logClust.logTemplate))
             occurrence = len(logClust.logIDL)
             level = logClust.level
             template_id = hashlib.md5(template_str.encode('utf-8')).hexdigest()[0:8]
@@ -236,6 +359,12 @@ class LogParser:
         df_event.to_csv(os.path.join(self.savePath, logname + '_templates.csv'), index=False, columns=["EventId", "Level", "EventTemplate", "Occurrences"])
 
 
+    def outputColumnar(self, df_log, logClustL, logname, rowGroupSize=DEFAULT_ROW_GROUP_SIZE):
+        """ outputResult as parquet files with a template dictionary and an
+        EventIdx column, see output.write_columnar
+        """
+        write_columnar(self.savePath, logname, df_log, logClustL, self.tokens, rowGroupSize)
+
     def printTree(self, node, dep):
         pStr = ''
         for i in range(dep):
@@ -246,7 +375,7 @@ class LogParser:
         elif node.depth == 1:
             pStr += '<' + str(node.digitOrtoken) + '>'
         else:
-            pStr += node.digitOrtoken
+            pStr += self.tokens.decode_token(node.digitOrtoken)
 
         print(pStr)
 
@@ -256,36 +385,165 @@ class LogParser:
             self.printTree(node.childD[child], dep+1)
 
     def add_log(self, log_id, log_message, level):
-        matchCluster = self.treeSearch(self.rootNode, log_message)
+        seq = self.tokens.lookup(log_message)
+        seqLen = len(seq)
+        # matching only depends on the subtree of the message length, a message
+        # that left it unchanged matches the same cluster until it changes
+        cache = self.cache
+        if cache is not None:
+            key = seq.tobytes()
+            version = self.versions.get(seqLen, 0)
+            matchCluster = cache.get(key, version)
+            if matchCluster is not None:
+                matchCluster.logIDL.append(log_id)
+                self.lastCluster = matchCluster
+                return "existing"
+        matchCluster = self.treeSearch(self.rootNode, seq)
         #Match no existing log cluster
         if matchCluster is None:
-            newCluster = Logcluster(logTemplate=log_message, logIDL=[log_id], level=level)
+            newCluster = Logcluster(logTemplate=self.tokens.encode(log_message), logIDL=[log_id], level=level)
             self.logCluL.append(newCluster)
             self.addSeqToPrefixTree(self.rootNode, newCluster)
+            self.versions[seqLen] = self.versions.get(seqLen, 0) + 1
+            self.lastCluster = newCluster
             return "new"
         #Add the new log message to the existing cluster
         else:
-            newTemplate = self.getTemplate(log_message, matchCluster.logTemplate)
+            newTemplate = self.getTemplate(seq, matchCluster.logTemplate)
             matchCluster.logIDL.append(log_id)
-            if ' '.join(newTemplate) != ' '.join(matchCluster.logTemplate):
+            self.lastCluster = matchCluster
+            if newTemplate != matchCluster.logTemplate:
                 matchCluster.logTemplate = newTemplate
                 matchCluster.level = level
+                matchCluster.bucket.update(matchCluster.bucketRow, newTemplate)
+                self.versions[seqLen] = self.versions.get(seqLen, 0) + 1
+            elif cache is not None:
+                cache.put(key, matchCluster, version)
             return "existing"
 
+    def getState(self):
+        """ Token dictionary, prefix tree and clusters for a checkpoint
+        """
+        return {'tokens': self.tokens, 'rootNode': self.rootNode, 'logCluL': self.logCluL}
+
+    def setState(self, state):
+        """ Restores a getState checkpoint. Line ids belong to the run that
+        assigned them, the restored clusters start without any.
+        """
+        self.tokens = state['tokens']
+        self.wildcard = self.tokens.encode_token('<*>')
+        self.rootNode = state['rootNode']
+        self.logCluL = state['logCluL']
+        self.versions = dict()
+        if self.cache is not None:
+            self.cache.clear()
+
+
+    def tokenize(self, content):
+        return content.strip().split()
 
     def parse(self, df_log):
+        self.parse_columns(df_log['LineId'].values, df_log['Content'].values, df_log['Level'].values)
+
+    def parse_columns(self, line_ids, contents, levels):
+        """ Parses column arrays of line ids, contents and levels
+        """
+        if self.workers > 1 and len(self.logCluL) == 0:
+            return self.parseParallel(line_ids, contents, levels)
+        return self.parse_records(zip(line_ids, contents, levels), total=len(line_ids))
+
+    def partitionLengths(self, seqLens):
+        """ Assigns every message length to a worker, the most frequent lengths
+        first and each to the least loaded worker
+        """
+        loads = [0] * self.workers
+        owners = dict()
+        for seqLen, count in Counter(seqLens).most_common():
+            worker = loads.index(min(loads))
+            owners[seqLen] = worker
+            loads[worker] += count
+        return owners
+
+    def parseParallel(self, line_ids, contents, levels):
+        """ Parses the messages in worker processes that each own the prefix
+        subtrees of a disjoint set of message lengths. No cluster spans two
+        lengths and every worker sees its messages in input order, so merging
+        the clusters by the message that created them gives the clusters,
+        tree and templates of a sequential run.
+        """
         start_time = datetime.now()
 
-        count = 0
-        for idx, line in df_log.iterrows():
-            log_id = line['LineId']
-            log_message = line['Content'].strip().split()
-            level = line['Level'].strip()
+        seqLens = [len(self.tokenize(content)) for content in contents]
+        owners = self.partitionLengths(seqLens)
+        positions = [[] for _ in range(self.workers)]
+        for position, seqLen in enumerate(seqLens):
+            positions[owners[seqLen]].append(position)
+
+        clusters = []
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = [(part, executor.submit(_parseLengths, self.depth, self.st, self.maxChild,
+                                              [line_ids[i] for i in part],
+                                              [contents[i] for i in part],
+                                              [levels[i] for i in part]))
+                       for part in positions if part]
+            for part, future in futures:
+                for index, firstSeq, template, logIDL, level in future.result():
+                    clusters.append((part[index], firstSeq, template, logIDL, level))
+
+        clusters.sort(key=lambda cluster: cluster[0])
+        for _, firstSeq, template, logIDL, level in clusters:
+            # the tree path and bucket row come from the message that created the cluster
+            logClust = Logcluster(logTemplate=self.tokens.encode(firstSeq), level=level)
+            logClust.logIDL = logIDL
+            self.logCluL.append(logClust)
+            self.addSeqToPrefixTree(self.rootNode, logClust)
+            logClust.logTemplate = self.tokens.encode(template)
+            # messages shorter than the tree depth leave their cluster out of the leaf buckets
+            if logClust.bucket is not None:
+                logClust.bucket.update(logClust.bucketRow, logClust.logTemplate)
+
+        print('Parsing done. [Time taken: {!s}]'.format(datetime.now() - start_time))
+        return len(contents)
+
+    def parse_stream(self, batches):
+        """ Parses batches of (line id, content, level) records as they are
+        produced, e.g. by Preprocessor.iter_records
+        """
+        return self.parse_records(itertools.chain.from_iterable(batches))
 
-            self.add_log(log_id, log_message, level)
+    def parse_records(self, records, total=None):
+        """ Parses an iterable of (line id, content, level) records
+        """
+        start_time = datetime.now()
+
+        count = 0
+        for log_id, content, level in records:
+            self.add_log(log_id, self.tokenize(content), level.strip())
 
             count += 1
-            if count % 1000 == 0 or count == len(df_log):
-                print('Processed {0:.1f}% of log lines.'.format(count * 100.0 / len(df_log)))
+            if total is None:
+                if count % 100000 == 0:
+                    print('Processed {0} log lines.'.format(count))
+            elif count % 1000 == 0 or count == total:
+                print('Processed {0:.1f}% of log lines.'.format(count * 100.0 / total))
 
         print('Parsing done. [Time taken: {!s}]'.format(datetime.now() - start_time))
+        if self.cache is not None:
+            print('Match cache: {!s}'.format(self.cache))
+        return count
+
+
+def _parseLengths(depth, st, maxChild, line_ids, contents, levels):
+    """ Parses the messages of a set of lengths in a worker process of
+    LogParser.parseParallel. Returns for every cluster, in creation order,
+    the index of the message that created it, that message, the template,
+    the line ids and the level.
+    """
+    parser = LogParser(depth=depth + 2, st=st, maxChild=maxChild, tokens=TokenDictionary())
+    firsts = []
+    for index, (log_id, content, level) in enumerate(zip(line_ids, contents, levels)):
+        log_message = parser.tokenize(content)
+        if parser.add_log(log_id, log_message, level.strip()) == "new":
+            firsts.append((index, log_message))
+    return [(index, firstSeq, parser.tokens.decode(logClust.logTemplate), logClust.logIDL, logClust.level)
+            for (index, firstSeq), logClust in zip(firsts, parser.logCluL)]
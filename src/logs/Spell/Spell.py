@@ -5,7 +5,13 @@ import sys
 import numpy as np
 import pandas as pd
 import hashlib
+import itertools
+import math
+from array import array
 from datetime import datetime
+from tokens import shared_tokens
+from cache import DEFAULT_CACHE_SIZE, MatchCache
+from output import DEFAULT_ROW_GROUP_SIZE, write_columnar
 
 try:
     # Python 2
@@ -14,18 +20,118 @@ except NameError:
     # Python 3, xrange is now named range
     xrange = range
 
+class LCSEngine:
+    """ Longest common subsequence by dynamic programming over a flat
+    buffer that is reused between calls
+    """
+    def __init__(self):
+        self.buffer = array('i')
+
+    def _fill(self, seq1, seq2):
+        cols = len(seq2) + 1
+        size = (len(seq1) + 1) * cols
+        if len(self.buffer) < size:
+            self.buffer = array('i', bytes(4 * size))
+        lengths = self.buffer
+        for j in xrange(cols):
+            lengths[j] = 0
+        row = 0
+        for token1 in seq1:
+            nextRow = row + cols
+            lengths[nextRow] = 0
+            for j in xrange(1, cols):
+                if token1 == seq2[j - 1]:
+                    lengths[nextRow + j] = lengths[row + j - 1] + 1
+                else:
+                    left = lengths[nextRow + j - 1]
+                    up = lengths[row + j]
+                    lengths[nextRow + j] = left if left > up else up
+            row = nextRow
+        return lengths, cols
+
+    def prepare(self, seq):
+        """ Per-sequence state reused when seq is compared to many templates
+        """
+        return seq
+
+    def length(self, prepared, seq2):
+        lengths, cols = self._fill(prepared, seq2)
+        return lengths[len(prepared) * cols + len(seq2)]
+
+    def lcs(self, seq1, seq2):
+        lengths, cols = self._fill(seq1, seq2)
+
+        # read the substring out from the matrix
+        result = []
+        lenOfSeq1, lenOfSeq2 = len(seq1), len(seq2)
+        while lenOfSeq1 != 0 and lenOfSeq2 != 0:
+            current = lengths[lenOfSeq1 * cols + lenOfSeq2]
+            if current == lengths[(lenOfSeq1 - 1) * cols + lenOfSeq2]:
+                lenOfSeq1 -= 1
+            elif current == lengths[lenOfSeq1 * cols + lenOfSeq2 - 1]:
+                lenOfSeq2 -= 1
+            else:
+                assert seq1[lenOfSeq1-1] == seq2[lenOfSeq2-1]
+                result.append(seq1[lenOfSeq1-1])
+                lenOfSeq1 -= 1
+                lenOfSeq2 -= 1
+        result.reverse()
+        return result
+
+
+class BitParallelLCSEngine(LCSEngine):
+    """ Computes LCS lengths with the bit-vector algorithm of Hyyro, one
+    machine word per 64 positions of the prepared sequence. Subsequences
+    are still read out of the DP matrix, only for the winning template.
+    """
+    def prepare(self, seq):
+        masks = dict()
+        bit = 1
+        for token in seq:
+            masks[token] = masks.get(token, 0) | bit
+            bit <<= 1
+        return len(seq), bit - 1, masks
+
+    def length(self, prepared, seq2):
+        size, full, masks = prepared
+        v = full
+        for token in seq2:
+            match = masks.get(token)
+            if match:
+                u = v & match
+                v = ((v + u) | (v - u)) & full
+        return size - bin(v).count('1')
+
+
 class LCSObject:
     """ Class object to store a log group with the same template
     """
-    def __init__(self, level, logTemplate='', logIDL=[]):
+    __slots__ = ('logTemplate', 'logIDL', 'level', 'clusterId', 'tokenSet', 'constLen', 'keyToken')
+
+    def __init__(self, level, logTemplate='', logIDL=None):
         self.logTemplate = logTemplate
-        self.logIDL = logIDL
+        self.logIDL = array('l') if logIDL is None else array('l', logIDL)
         self.level = level
+        # maintained by LogParser.indexCluster
+        self.clusterId = None
+        self.tokenSet = None
+        self.constLen = 0
+        self.keyToken = None
+
+    def __getstate__(self):
+        # line ids belong to the run that assigned them and are not checkpointed
+        return (self.logTemplate, self.level, self.clusterId, self.tokenSet, self.constLen, self.keyToken)
+
+    def __setstate__(self, state):
+        self.logTemplate, self.level, self.clusterId, self.tokenSet, self.constLen, self.keyToken = state
+        self.logIDL = array('l')
 
 
 class Node:
     """ A node in prefix tree data structure
     """
+    __slots__ = ('logClust', 'token', 'templateNo', 'childD')
+
     def __init__(self, token='', templateNo=0):
         self.logClust = None
         self.token = token
@@ -42,47 +148,103 @@ class LogParser:
         logName : the file name of the input file
         savePath : the path of the output file
         tau : how much percentage of tokens matched to merge a log message
+        tokens : token dictionary the templates are encoded with
     """
-    def __init__(self, outdir='./result/', tau=0.5):
+    def __init__(self, outdir='./result/', tau=0.5, lcsEngine=None, tokens=None, cacheSize=DEFAULT_CACHE_SIZE):
         self.savePath = outdir
         self.tau = tau
+        if tokens is None:
+            tokens = shared_tokens
+        self.tokens = tokens
+        self.wildcard = tokens.encode_token('*')
+        if lcsEngine is None:
+            lcsEngine = BitParallelLCSEngine()
+        self.lcsEngine = lcsEngine
+        self.rootNode = Node()
+        self.logCluL = []
+        # constant token -> ids (positions in logCluL) of the clusters using it
+        self.tokenIndex = dict()
+        # every cluster is also filed under one of its rarest constant tokens
+        self.keyIndex = dict()
+        # clusters whose template has no constant token
+        self.wildcardClusters = set()
+        self.cache = MatchCache(cacheSize) if cacheSize > 0 else None
+        # bumped whenever a cluster is added or a template changes
+        self.version = 0
+        # cluster of the message add_log was called with last
+        self.lastCluster = None
+
+    def indexCluster(self, logClust):
+        tokenSet = set(logClust.logTemplate)
+        logClust.tokenSet = tokenSet
+        logClust.constLen = sum(1 for w in logClust.logTemplate if w != self.wildcard)
+        keyToken = None
+        for token in tokenSet:
+            if token == self.wildcard:
+                continue
+            clusterIds = self.tokenIndex.setdefault(token, set())
+            clusterIds.add(logClust.clusterId)
+            if keyToken is None or len(clusterIds) < len(self.tokenIndex[keyToken]):
+                keyToken = token
+        logClust.keyToken = keyToken
+        if keyToken is None:
+            self.wildcardClusters.add(logClust.clusterId)
+        else:
+            self.keyIndex.setdefault(keyToken, set()).add(logClust.clusterId)
+
+    def unindexCluster(self, logClust):
+        for token in logClust.tokenSet:
+            clusterIds = self.tokenIndex.get(token)
+            if clusterIds is not None:
+                clusterIds.discard(logClust.clusterId)
+                if not clusterIds:
+                    del self.tokenIndex[token]
+        if logClust.keyToken is None:
+            self.wildcardClusters.discard(logClust.clusterId)
+        else:
+            clusterIds = self.keyIndex[logClust.keyToken]
+            clusterIds.discard(logClust.clusterId)
+            if not clusterIds:
+                del self.keyIndex[logClust.keyToken]
+
+    def addCluster(self, logClust):
+        logClust.clusterId = len(self.logCluL)
+        self.logCluL.append(logClust)
+        self.indexCluster(logClust)
+
+    def overlapCandidates(self, tokens, minShared):
+        """ Ids of the clusters that may share minShared of the distinct constant
+        tokens. Such a cluster holds one of the len(tokens) - minShared + 1
+        rarest of them, so only their postings are read.
+        """
+        index = self.tokenIndex
+        tokens = sorted(tokens, key=lambda token: len(index.get(token, ())))
+        candidates = set()
+        for token in tokens[:len(tokens) - minShared + 1]:
+            if token in index:
+                candidates.update(index[token])
+        return candidates
 
     def LCS(self, seq1, seq2):
-        lengths = [[0 for j in range(len(seq2)+1)] for i in range(len(seq1)+1)]
-        # row 0 and column 0 are initialized to 0 already
-        for i in range(len(seq1)):
-            for j in range(len(seq2)):
-                if seq1[i] == seq2[j]:
-                    lengths[i+1][j+1] = lengths[i][j] + 1
-                else:
-                    lengths[i+1][j+1] = max(lengths[i+1][j], lengths[i][j+1])
-
-        # read the substring out from the matrix
-        result = []
-        lenOfSeq1, lenOfSeq2 = len(seq1), len(seq2)
-        while lenOfSeq1!=0 and lenOfSeq2 != 0:
-            if lengths[lenOfSeq1][lenOfSeq2] == lengths[lenOfSeq1-1][lenOfSeq2]:
-                lenOfSeq1 -= 1
-            elif lengths[lenOfSeq1][lenOfSeq2] == lengths[lenOfSeq1][lenOfSeq2-1]:
-                lenOfSeq2 -= 1
-            else:
-                assert seq1[lenOfSeq1-1] == seq2[lenOfSeq2-1]
-                result.insert(0,seq1[lenOfSeq1-1])
-                lenOfSeq1 -= 1
-                lenOfSeq2 -= 1
-        return result
+        return self.lcsEngine.lcs(seq1, seq2)
 
 
     def SimpleLoopMatch(self, logClustL, seq):
         retLogClust = None
 
-        for logClust in logClustL:
+        #A template whose constant tokens all occur in seq is filed under one of them
+        seqTokens = set(seq)
+        seqTokens.add(self.wildcard)
+        keyIndex = self.keyIndex
+        candidates = [clusterId for token in seqTokens if token in keyIndex
+                      for clusterId in keyIndex[token]]
+        candidates.extend(self.wildcardClusters)
+        for clusterId in sorted(candidates):
+            logClust = logClustL[clusterId]
             if float(len(logClust.logTemplate)) < 0.5 * len(seq):
                 continue
 
-            #If the template is a subsequence of seq
-            it = iter(seq)
-            if all(token in seq or token == '*' for token in logClust.logTemplate):
+            if logClust.tokenSet <= seqTokens:
                 return logClust
 
         return retLogClust
@@ -95,8 +257,7 @@ class LogParser:
             if seq[i] in parentn.childD:
                 childn = parentn.childD[seq[i]]
                 if (childn.logClust is not None):
-                    constLM = [w for w in childn.logClust.logTemplate if w != '*']
-                    if float(len(constLM)) >= self.tau * length:
+                    if float(childn.logClust.constLen) >= self.tau * length:
                         return childn.logClust
                 else:
                     return self.PrefixTreeMatch(childn, seq, i + 1)
@@ -108,18 +269,29 @@ class LogParser:
         retLogClust = None
 
         maxLen = -1
-        maxlcs = []
         maxClust = None
         set_seq = set(seq)
         size_seq = len(seq)
-        for logClust in logClustL:
-            set_template = set(logClust.logTemplate)
-            if len(set_seq & set_template) < 0.5 * size_seq:
+        minLen = self.tau * size_seq
+        prepared = self.lcsEngine.prepare(seq)
+        # '*' adds at most one shared token, the rest are constant tokens
+        minShared = int(math.ceil(0.5 * size_seq)) - (1 if self.wildcard in set_seq else 0)
+        if minShared > 0:
+            candidates = sorted(self.overlapCandidates([w for w in set_seq if w != self.wildcard], minShared))
+        else:
+            candidates = xrange(len(logClustL))
+        for clusterId in candidates:
+            logClust = logClustL[clusterId]
+            # the LCS cannot be longer than the shorter sequence
+            bound = min(size_seq, len(logClust.logTemplate))
+            if bound < minLen or bound < maxLen or \
+                    (bound == maxLen and len(logClust.logTemplate) >= len(maxClust.logTemplate)):
                 continue
-            lcs = self.LCS(seq, logClust.logTemplate)
-            if len(lcs) > maxLen or (len(lcs) == maxLen and len(logClust.logTemplate) < len(maxClust.logTemplate)):
-                maxLen = len(lcs)
-                maxlcs = lcs
+            if len(set_seq & logClust.tokenSet) < 0.5 * size_seq:
+                continue
+            lcsLen = self.lcsEngine.length(prepared, logClust.logTemplate)
+            if lcsLen > maxLen or (lcsLen == maxLen and len(logClust.logTemplate) < len(maxClust.logTemplate)):
+                maxLen = lcsLen
                 maxClust = logClust
 
         # LCS should be large then tau * len(itself)
@@ -130,7 +302,7 @@ class LogParser:
 
 
     def getTemplate(self, lcs, seq):
-        retVal = []
+        retVal = array('i')
         if not lcs:
             return retVal
 
@@ -142,17 +314,17 @@ class LogParser:
                 retVal.append(token)
                 lcs.pop()
             else:
-                retVal.append('*')
+                retVal.append(self.wildcard)
             if not lcs:
                 break
         if i < len(seq):
-            retVal.append('*')
+            retVal.append(self.wildcard)
         return retVal
 
     def addSeqToPrefixTree(self, rootn, newCluster):
         parentn = rootn
         seq = newCluster.logTemplate
-        seq = [w for w in seq if w != '*']
+        seq = [w for w in seq if w != self.wildcard]
 
         for i in xrange(len(seq)):
             tokenInSeq = seq[i]
@@ -171,7 +343,7 @@ class LogParser:
     def removeSeqFromPrefixTree(self, rootn, newCluster):
         parentn = rootn
         seq = newCluster.logTemplate
-        seq = [w for w in seq if w != '*']
+        seq = [w for w in seq if w != self.wildcard]
 
         for tokenInSeq in seq:
             if tokenInSeq in parentn.childD:
@@ -194,7 +366,7 @@ class LogParser:
         df_event = []
 
         for logclust in logClustL:
-            template_str = ' '.join(logclust.logTemplate)
+            template_str = ' '.join(self.tokens.decode(logclust.logTemplate))
             level = logclust.level
             eid = hashlib.md5(template_str.encode('utf-8')).hexdigest()[0:8]
             for logid in logclust.logIDL:
@@ -214,6 +386,12 @@ class LogParser:
         df_event.to_csv(os.path.join(self.savePath, logname + '_templates.csv'), index=False)
 
 
+    def outputColumnar(self, df_log, logClustL, logname, rowGroupSize=DEFAULT_ROW_GROUP_SIZE):
+        """ outputResult as parquet files with a template dictionary and an
+        EventIdx column, see output.write_columnar
+        """
+        write_columnar(self.savePath, logname, df_log, logClustL, self.tokens, rowGroupSize)
+
     def printTree(self, node, dep):
         pStr = ''
         for i in xrange(dep):
@@ -222,53 +400,139 @@ class LogParser:
         if node.token == '':
             pStr += 'Root'
         else:
-            pStr += node.token
+            pStr += self.tokens.decode_token(node.token)
             if node.logClust is not None:
-                pStr += '-->' + ' '.join(node.logClust.logTemplate)
+                pStr += '-->' + ' '.join(self.tokens.decode(node.logClust.logTemplate))
         print(pStr +' ('+ str(node.templateNo) + ')')
 
         for child in node.childD:
             self.printTree(node.childD[child], dep + 1)
 
 
-    def parse(self, df_log):
-        starttime = datetime.now()
-        rootNode = Node()
-        logCluL = []
+    def add_log(self, log_id, log_message, level):
+        seq = self.tokens.lookup(log_message)
+        # a message that left the clusters unchanged matches the same cluster
+        # until any cluster changes
+        cache = self.cache
+        if cache is not None:
+            key = seq.tobytes()
+            version = self.version
+            matchCluster = cache.get(key, version)
+            if matchCluster is not None:
+                matchCluster.logIDL.append(log_id)
+                self.lastCluster = matchCluster
+                return "existing"
+        constLogMessL = [w for w in seq if w != self.wildcard]
 
-        count = 0
-        for idx, line in df_log.iterrows():
-            logID = line['LineId']
-            logmessageL = list(filter(lambda x: x != '', re.split(r'[\s=:,]', line['Content'])))
-            constLogMessL = [w for w in logmessageL if w != '*']
+        #Find an existing matched log cluster
+        matchCluster = self.PrefixTreeMatch(self.rootNode, constLogMessL, 0)
 
-            #Find an existing matched log cluster
-            matchCluster = self.PrefixTreeMatch(rootNode, constLogMessL, 0)
+        if matchCluster is None:
+            matchCluster = self.SimpleLoopMatch(self.logCluL, constLogMessL)
 
             if matchCluster is None:
-                matchCluster = self.SimpleLoopMatch(logCluL, constLogMessL)
+                matchCluster = self.LCSMatch(self.logCluL, seq)
 
+                # Match no existing log cluster
                 if matchCluster is None:
-                    matchCluster = self.LCSMatch(logCluL, logmessageL)
-
-                    # Match no existing log cluster
-                    if matchCluster is None:
-                        newCluster = LCSObject(logTemplate=logmessageL, logIDL=[logID], level = line['Level'])
-                        logCluL.append(newCluster)
-                        self.addSeqToPrefixTree(rootNode, newCluster)
-                    #Add the new log message to the existing cluster
-                    else:
-                        newTemplate = self.getTemplate(self.LCS(logmessageL, matchCluster.logTemplate),
-                                                       matchCluster.logTemplate)
-                        if ' '.join(newTemplate) != ' '.join(matchCluster.logTemplate):
-                            self.removeSeqFromPrefixTree(rootNode, matchCluster)
-                            matchCluster.logTemplate = newTemplate
-                            matchCluster.level = line['Level']
-                            self.addSeqToPrefixTree(rootNode, matchCluster)
-            if matchCluster:
-                matchCluster.logIDL.append(logID)
+                    newCluster = LCSObject(logTemplate=self.tokens.encode(log_message), logIDL=[log_id], level=level)
+                    self.addCluster(newCluster)
+                    self.addSeqToPrefixTree(self.rootNode, newCluster)
+                    self.version += 1
+                    self.lastCluster = newCluster
+                    return "new"
+                #Add the new log message to the existing cluster
+                else:
+                    newTemplate = self.getTemplate(self.LCS(seq, matchCluster.logTemplate),
+                                                   matchCluster.logTemplate)
+                    if newTemplate != matchCluster.logTemplate:
+                        self.removeSeqFromPrefixTree(self.rootNode, matchCluster)
+                        self.unindexCluster(matchCluster)
+                        matchCluster.logTemplate = newTemplate
+                        matchCluster.level = level
+                        self.indexCluster(matchCluster)
+                        self.addSeqToPrefixTree(self.rootNode, matchCluster)
+                        self.version += 1
+        if cache is not None and self.version == version:
+            cache.put(key, matchCluster, version)
+        matchCluster.logIDL.append(log_id)
+        self.lastCluster = matchCluster
+        return "existing"
+
+    def getState(self):
+        """ Token dictionary, clusters, their indexes and the prefix tree for a
+        checkpoint. The tree is kept as a flat list of (parent, token, templateNo,
+        clusterId) nodes, its depth grows with the template length.
+        """
+        tree = []
+        nodes = [(-1, self.rootNode)]
+        i = 0
+        while i < len(nodes):
+            parent, node = nodes[i]
+            clusterId = None if node.logClust is None else node.logClust.clusterId
+            tree.append((parent, node.token, node.templateNo, clusterId))
+            nodes.extend((i, child) for child in node.childD.values())
+            i += 1
+        return {'tokens': self.tokens, 'tree': tree, 'logCluL': self.logCluL,
+                'tokenIndex': self.tokenIndex, 'keyIndex': self.keyIndex,
+                'wildcardClusters': self.wildcardClusters}
+
+    def setState(self, state):
+        """ Restores a getState checkpoint. Line ids belong to the run that
+        assigned them, the restored clusters start without any.
+        """
+        self.tokens = state['tokens']
+        self.wildcard = self.tokens.encode_token('*')
+        self.logCluL = state['logCluL']
+        self.tokenIndex = state['tokenIndex']
+        self.keyIndex = state['keyIndex']
+        self.wildcardClusters = state['wildcardClusters']
+        nodes = []
+        for parent, token, templateNo, clusterId in state['tree']:
+            node = Node(token=token, templateNo=templateNo)
+            if clusterId is not None:
+                node.logClust = self.logCluL[clusterId]
+            if parent >= 0:
+                nodes[parent].childD[token] = node
+            nodes.append(node)
+        self.rootNode = nodes[0]
+        self.version = 0
+        if self.cache is not None:
+            self.cache.clear()
+
+    def tokenize(self, content):
+        return list(filter(lambda x: x != '', re.split(r'[\s=:,]', content)))
+
+    def parse(self, df_log):
+        self.parse_columns(df_log['LineId'].values, df_log['Content'].values, df_log['Level'].values)
+
+    def parse_columns(self, line_ids, contents, levels):
+        """ Parses column arrays of line ids, contents and levels
+        """
+        return self.parse_records(zip(line_ids, contents, levels), total=len(line_ids))
+
+    def parse_stream(self, batches):
+        """ Parses batches of (line id, content, level) records as they are
+        produced, e.g. by Preprocessor.iter_records
+        """
+        return self.parse_records(itertools.chain.from_iterable(batches))
+
+    def parse_records(self, records, total=None):
+        """ Parses an iterable of (line id, content, level) records
+        """
+        starttime = datetime.now()
+
+        count = 0
+        for logID, content, level in records:
+            self.add_log(logID, self.tokenize(content), level)
+
             count += 1
-            if count % 1000 == 0 or count == len(df_log):
-                print('Processed {0:.1f}% of log lines.'.format(count * 100.0 / len(df_log)))
-        self.logCluL = logCluL
+            if total is None:
+                if count % 100000 == 0:
+                    print('Processed {0} log lines.'.format(count))
+            elif count % 1000 == 0 or count == total:
+                print('Processed {0:.1f}% of log lines.'.format(count * 100.0 / total))
         print('Parsing done. [Time taken: {!s}]'.format(datetime.now() - starttime))
+        if self.cache is not None:
+            print('Match cache: {!s}'.format(self.cache))
+        return count
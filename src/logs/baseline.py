@@ -0,0 +1,252 @@
+import os
+import csv
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+BLOOM_BITS_PER_KEY = 16  # bits of the Bloom filter per baseline key
+BLOOM_HASHES = 4  # bits set per key, about 0.2% false positives at 16 bits per key
+DEFAULT_FREQUENCY_FACTOR = 2.0  # change of the relative frequency reported as frequency change
+DEFAULT_MIN_COUNT = 10  # occurrences below which frequency changes are not reported
+
+# odd multiplier spreading the bits of a key before it is split into hashes
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+def template_keys(event_ids):
+    """ Integer keys of 8 hex digit md5 EventIds
+    """
+    return np.array([int(event_id, 16) for event_id in event_ids], dtype = np.uint64)
+
+def fingerprint_keys(fingerprints):
+    """ uint64 keys of the first 8 bytes of hex exception fingerprints
+    """
+    return np.array([int(fingerprint[:16], 16) for fingerprint in fingerprints], dtype = np.uint64)
+
+class BloomFilter:
+    """ Bit array answering whether a key may be in a set, without false
+    negatives. Keys are hashes already, the BLOOM_HASHES bit positions are
+    derived from the two halves of the mixed key.
+    """
+    def __init__(self, bits):
+        self.bits = bits
+
+    @classmethod
+    def from_keys(cls, keys, bits_per_key = BLOOM_BITS_PER_KEY):
+        size = max(64, len(keys) * bits_per_key)
+        bloom = cls(np.zeros((size + 7) // 8, dtype = np.uint8))
+        positions = bloom._positions(keys).ravel()
+        np.bitwise_or.at(bloom.bits, positions >> 3, (1 << (positions & 7)).astype(np.uint8))
+        return bloom
+
+    def contains(self, keys):
+        positions = self._positions(keys)
+        found = (self.bits[positions >> 3] >> (positions & 7).astype(np.uint8)) & 1
+        return found.all(axis = 1) if len(keys) > 0 else np.zeros(0, dtype = bool)
+
+    def _positions(self, keys):
+        mixed = np.asarray(keys, dtype = np.uint64) * _MIX
+        low = mixed & np.uint64(0xFFFFFFFF)
+        high = (mixed >> np.uint64(32)) | np.uint64(1)
+        steps = np.arange(BLOOM_HASHES, dtype = np.uint64)
+        return ((low[:, None] + steps[None, :] * high[:, None]) % np.uint64(len(self.bits) * 8)).astype(np.int64)
+
+class KeyCounts:
+    """ Sorted keys with their occurrences and labels, the labels packed as
+    utf-8 bytes with their offsets
+    """
+    NAMES = ('keys', 'counts', 'label_bytes', 'label_offsets', 'bloom')
+
+    def __init__(self, keys, counts, label_bytes, label_offsets, bloom):
+        self.keys = keys
+        self.counts = counts
+        self.label_bytes = label_bytes
+        self.label_offsets = label_offsets
+        self.bloom = bloom
+
+    @classmethod
+    def from_rows(cls, keys, labels, counts):
+        """ Keys, labels and counts of rows, the counts of repeated keys summed
+        """
+        keys = np.asarray(keys, dtype = np.uint64)
+        counts = np.asarray(counts, dtype = np.int64)
+        unique_keys, first, inverse = np.unique(keys, return_index = True, return_inverse = True)
+        counts = np.bincount(inverse, weights = counts, minlength = len(unique_keys)).astype(np.int64)
+        encoded = [labels[index].encode('utf-8') for index in first]
+        label_offsets = np.zeros(len(encoded) + 1, dtype = np.int64)
+        np.cumsum([len(label) for label in encoded], out = label_offsets[1:])
+        label_bytes = np.frombuffer(b''.join(encoded), dtype = np.uint8)
+        return cls(unique_keys, counts, label_bytes, label_offsets, BloomFilter.from_keys(unique_keys).bits)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def label(self, index):
+        return self.label_bytes[self.label_offsets[index]:self.label_offsets[index + 1]].tobytes().decode('utf-8')
+
+    def lookup(self, keys):
+        """ Index of every key in this set, -1 for the keys that are not in it.
+        Only the keys the Bloom filter lets through are searched for.
+        """
+        keys = np.asarray(keys, dtype = np.uint64)
+        indexes = np.full(len(keys), -1, dtype = np.int64)
+        candidates = np.flatnonzero(BloomFilter(self.bloom).contains(keys)) if len(self.keys) > 0 else []
+        if len(candidates) > 0:
+            positions = np.searchsorted(self.keys, keys[candidates])
+            positions = np.minimum(positions, len(self.keys) - 1)
+            hits = self.keys[positions] == keys[candidates]
+            indexes[candidates[hits]] = positions[hits]
+        return indexes
+
+    def save(self, directory, prefix):
+        for name in self.NAMES:
+            np.save(os.path.join(directory, f'{prefix}_{name}.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory, prefix, mmap_mode = 'r'):
+        return cls(*[np.load(os.path.join(directory, f'{prefix}_{name}.npy'), mmap_mode = mmap_mode)
+                     for name in cls.NAMES])
+
+class BaselineReport:
+    """ Templates and exceptions of a run that are novel, that disappeared or
+    whose relative frequency changed by a factor compared to the baseline
+    """
+    COLUMNS = ['Kind', 'Id', 'Label', 'BaselineCount', 'RunCount', 'Ratio']
+
+    def __init__(self):
+        self.rows = []
+        self.summary = dict()
+
+    def add(self, kind, ids, labels, baseline_counts, run_counts, ratios):
+        self.summary[kind] = len(ids)
+        self.rows.extend(zip([kind] * len(ids), ids, labels, baseline_counts, run_counts, ratios))
+
+    def to_frame(self):
+        return pd.DataFrame(self.rows, columns = self.COLUMNS)
+
+    def __str__(self):
+        return ', '.join(f'{count} {kind}' for kind, count in self.summary.items())
+
+class BaselineIndex:
+    """ Templates and exception fingerprints of a known good run, saved as
+    numpy arrays in a directory of their own and memory mapped when loaded.
+    Templates are keyed by their EventId, exceptions by the first 8 bytes of
+    their fingerprint. A run is compared without reading the baseline's
+    CSV files, keys of the run are checked against a Bloom filter before
+    they are searched in the sorted baseline keys.
+    """
+    def __init__(self, templates, exceptions, lines):
+        self.templates = templates
+        self.exceptions = exceptions
+        self.lines = lines
+
+    @classmethod
+    def build(cls, directory, template_rows, exception_rows):
+        """ Saves the baseline of (EventId, template, occurrences) and
+        (fingerprint, identities, count) rows to directory
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        ids, labels, counts = _columns(template_rows)
+        templates = KeyCounts.from_rows(template_keys(ids), labels, counts)
+        ids, labels, counts = _columns(exception_rows)
+        exceptions = KeyCounts.from_rows(fingerprint_keys(ids), labels, counts)
+        templates.save(directory, 'templates')
+        exceptions.save(directory, 'exceptions')
+        lines = int(templates.counts.sum())
+        with open(os.path.join(directory, 'baseline.json'), 'w') as fout:
+            json.dump({'lines': lines, 'templates': len(templates), 'exceptions': len(exceptions)}, fout)
+        return cls(templates, exceptions, lines)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, 'baseline.json')) as fin:
+            meta = json.load(fin)
+        return cls(KeyCounts.load(directory, 'templates'), KeyCounts.load(directory, 'exceptions'), meta['lines'])
+
+    def compare(self, template_rows, exception_rows, factor = DEFAULT_FREQUENCY_FACTOR,
+                min_count = DEFAULT_MIN_COUNT):
+        """ Report of the (EventId, template, occurrences) and (fingerprint,
+        identities, count) rows of a run against the baseline. Frequencies are
+        relative to the lines, or exceptions, of the run and of the baseline.
+        """
+        report = BaselineReport()
+        ids, labels, counts = _columns(template_rows)
+        run = KeyCounts.from_rows(template_keys(ids), labels, counts)
+        self._compare(report, 'template', self.templates, run, '{:08x}', factor, min_count)
+        ids, labels, counts = _columns(exception_rows)
+        run = KeyCounts.from_rows(fingerprint_keys(ids), labels, counts)
+        self._compare(report, 'exception', self.exceptions, run, '{:016x}', factor, min_count)
+        return report
+
+    def _compare(self, report, name, baseline, run, id_format, factor, min_count):
+        indexes = baseline.lookup(run.keys)
+        novel = np.flatnonzero(indexes < 0)
+        report.add('novel ' + name, [id_format.format(key) for key in run.keys[novel].tolist()],
+                   [run.label(index) for index in novel], [0] * len(novel), run.counts[novel].tolist(),
+                   [np.inf] * len(novel))
+        disappeared = np.flatnonzero(~np.isin(baseline.keys, run.keys, assume_unique = True))
+        report.add('disappeared ' + name, [id_format.format(key) for key in baseline.keys[disappeared].tolist()],
+                   [baseline.label(index) for index in disappeared], baseline.counts[disappeared].tolist(),
+                   [0] * len(disappeared), [0.0] * len(disappeared))
+        known = np.flatnonzero(indexes >= 0)
+        run_counts = run.counts[known]
+        baseline_counts = np.asarray(baseline.counts[indexes[known]])
+        ratios = (run_counts / max(run.counts.sum(), 1)) / (baseline_counts / max(baseline.counts.sum(), 1))
+        changed = ((ratios >= factor) | (ratios <= 1 / factor)) & (np.maximum(run_counts, baseline_counts) >= min_count)
+        changed = np.flatnonzero(changed)
+        report.add('frequency changed ' + name, [id_format.format(key) for key in run.keys[known[changed]].tolist()],
+                   [run.label(index) for index in known[changed]], baseline_counts[changed].tolist(),
+                   run_counts[changed].tolist(), ratios[changed].tolist())
+
+def _columns(rows):
+    rows = list(rows)
+    if len(rows) == 0:
+        return [], [], []
+    ids, labels, counts = zip(*rows)
+    return ids, labels, counts
+
+def cluster_rows(logClustL, tokens):
+    """ (EventId, template, occurrences) of the clusters of Drain or Spell
+    with lines in this run
+    """
+    for logClust in logClustL:
+        if len(logClust.logIDL) == 0:
+            continue
+        template_str = ' '.join(tokens.decode(logClust.logTemplate))
+        yield hashlib.md5(template_str.encode('utf-8')).hexdigest()[0:8], template_str, len(logClust.logIDL)
+
+def exception_rows(text_index):
+    """ (fingerprint, identities, count) of the exceptions of a TextIndex in this run
+    """
+    for entry in text_index.entries():
+        yield entry.fingerprint.hex(), entry.identities, entry.count
+
+def read_templates(path):
+    """ (EventId, template, occurrences) rows of a _templates.csv or .parquet,
+    the csv read with the csv module
+    """
+    if path.endswith('.parquet'):
+        from output import _parquet
+        pa, pq = _parquet()
+        table = pq.read_table(path, columns = ['EventId', 'EventTemplate', 'Occurrences'])
+        return list(zip(*[table.column(name).to_pylist() for name in ('EventId', 'EventTemplate', 'Occurrences')]))
+    with open(path, newline = '') as fin:
+        return [(row['EventId'], row['EventTemplate'], int(row['Occurrences'])) for row in csv.DictReader(fin)]
+
+def read_exceptions(path):
+    """ (fingerprint, identities, count) rows of an _exceptions.csv
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, newline = '') as fin:
+        return [(row['Fingerprint'], row['Identities'], int(row['Count'])) for row in csv.DictReader(fin)]
+
+def build_baseline(output_dir, logname, baseline_dir, output_format = 'csv'):
+    """ Saves the templates and exceptions a run wrote to output_dir for the
+    source logname as the baseline of the source in baseline_dir
+    """
+    extension = '.parquet' if output_format == 'parquet' else '.csv'
+    return BaselineIndex.build(os.path.join(baseline_dir, logname),
+                               read_templates(os.path.join(output_dir, logname + '_templates' + extension)),
+                               read_exceptions(os.path.join(output_dir, logname + '_exceptions.csv')))
@@ -0,0 +1,51 @@
+from collections import OrderedDict
+
+DEFAULT_CACHE_SIZE = 10000  # distinct messages remembered by a MatchCache
+
+class MatchCache:
+    """ Bounded LRU map from a tokenized message to the cluster it matched.
+    Keys are the bytes of the message's token ids, so equal messages hash
+    alike without keeping their tokens. Every entry carries the version of
+    the parser state it was matched in and is only valid while the parser
+    reports the same version, the parser bumps it whenever a cluster is
+    added or a template is generalized.
+    """
+    __slots__ = ('capacity', 'entries', 'hits', 'misses', 'evictions')
+
+    def __init__(self, capacity = DEFAULT_CACHE_SIZE):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, version):
+        entry = self.entries.get(key)
+        if entry is None or entry[1] != version:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, cluster, version):
+        entries = self.entries
+        entries[key] = (cluster, version)
+        entries.move_to_end(key)
+        if len(entries) > self.capacity:
+            entries.popitem(last = False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def __str__(self):
+        return '{0} hits, {1} misses ({2:.1%} hit rate), {3} evictions, {4}/{5} entries'.format(
+            self.hits, self.misses, self.hit_rate(), self.evictions, len(self.entries), self.capacity)
@@ -0,0 +1,135 @@
+import os
+import json
+import gzip
+import pickle
+import hashlib
+
+HEAD_BYTES = 1024  # leading bytes of a file fingerprinted to notice a truncated and rewritten file
+
+def dump_state(path, state):
+    """ Writes a state as a compressed pickle, replacing the previous one
+    only once it is completely written
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb') as fout:
+        pickle.dump(state, fout, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def load_state(path):
+    with gzip.open(path, 'rb') as fin:
+        return pickle.load(fin)
+
+def file_head(file_path, length):
+    with open(file_path, 'rb') as fin:
+        return hashlib.blake2b(fin.read(length), digest_size = 16).hexdigest()
+
+class FileManifest:
+    """ Byte offsets up to which the files of a source have been parsed.
+    Files are recognized by device and inode so that a renamed (rotated) file
+    continues at its offset, a file that shrank or whose first bytes changed is
+    parsed again from the start. The offset is where the next run starts, the
+    start of a record that was held back, the end is the byte read up to.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = dict()
+        if os.path.exists(path):
+            with open(path, 'r') as fin:
+                self.entries = json.load(fin)
+
+    def entry(self, file_path):
+        """ Entry of the file, None if it is new or was rewritten
+        """
+        stat = os.stat(file_path)
+        for entry in self.entries.values():
+            if entry["device"] != stat.st_dev or entry["inode"] != stat.st_ino:
+                continue
+            if stat.st_size < entry.get("end", entry["offset"]):
+                return None
+            if file_head(file_path, entry["head_length"]) != entry["head"]:
+                return None
+            return entry
+        return None
+
+    def start_offset(self, file_path):
+        entry = self.entry(file_path)
+        return 0 if entry is None else entry["offset"]
+
+    def start_offsets(self, file_paths):
+        return {file_path: self.start_offset(file_path) for file_path in file_paths}
+
+    def complete_files(self, file_paths):
+        """ Files nothing was appended to since they were read, their held back
+        record is complete
+        """
+        complete = set()
+        for file_path in file_paths:
+            entry = self.entry(file_path)
+            if entry is not None and os.path.getsize(file_path) == entry.get("end", entry["offset"]):
+                complete.add(file_path)
+        return complete
+
+    def update(self, offsets, ends = None):
+        """ Replaces the entries with the given file offsets and ends, the
+        offsets by default
+        """
+        if ends is None:
+            ends = offsets
+        entries = dict()
+        for file_path, offset in offsets.items():
+            stat = os.stat(file_path)
+            end = ends.get(file_path, offset)
+            head_length = min(end, HEAD_BYTES)
+            entries[file_path] = {
+                "device": stat.st_dev,
+                "inode": stat.st_ino,
+                "offset": offset,
+                "end": end,
+                "head_length": head_length,
+                "head": file_head(file_path, head_length)
+            }
+        self.entries = entries
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fout:
+            json.dump(self.entries, fout, indent = 2, sort_keys = True)
+        os.replace(tmp_path, self.path)
+
+class SourceCheckpoint:
+    """ Parser state, exception index and file manifest of one logical source,
+    kept in a directory of their own. A run restores them, parses only the
+    bytes appended since the previous run and saves them again. The outputs
+    of a run cover the lines it parsed: line ids start at 1, and the
+    template occurrences and exception counts are those of the run, so runs
+    compare to a baseline and add to the registry one at a time.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.parser_path = os.path.join(directory, 'parser.state')
+        self.text_index_path = os.path.join(directory, 'text_index.state')
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.manifest = FileManifest(os.path.join(directory, 'manifest.json'))
+
+    def restore(self, extractor, text_index):
+        if os.path.exists(self.parser_path):
+            extractor.setState(load_state(self.parser_path))
+        if os.path.exists(self.text_index_path):
+            text_index.set_state(load_state(self.text_index_path))
+
+    def start_offsets(self, file_paths):
+        return self.manifest.start_offsets(file_paths)
+
+    def complete_files(self, file_paths):
+        return self.manifest.complete_files(file_paths)
+
+    def save(self, extractor, text_index, offsets, ends = None):
+        dump_state(self.parser_path, extractor.getState())
+        dump_state(self.text_index_path, text_index.get_state())
+        # written last, a run interrupted before it parses the same bytes again
+        self.manifest.update(offsets, ends)
+        self.manifest.save()
@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from datetime import datetime
+
+DEFAULT_TOP_K = 10  # correlated templates reported per template
+DEFAULT_MEMORY_BUDGET = 256 << 20  # bytes of the dense blocks of correlations
+
+def count_matrix(window_counts, errors = False):
+    """ Sparse templates x windows CSR matrix of the line counts, or of the
+    error line counts, of a WindowCounts
+    """
+    counts = window_counts.error_counts if errors else window_counts.counts
+    present = counts > 0
+    return scipy.sparse.csr_matrix(
+        (counts[present].astype(np.float64), (window_counts.rows[present], window_counts.windows[present])),
+        shape = (len(window_counts.events), len(window_counts)))
+
+def block_rows(templates, memory_budget = DEFAULT_MEMORY_BUDGET):
+    """ Rows of a block whose products, correlations and their top-k
+    selection fit in memory_budget bytes
+    """
+    return max(1, memory_budget // (4 * 8 * max(templates, 1)))
+
+def moments(matrix):
+    """ Mean and standard deviation of every row of a sparse templates x
+    windows matrix, NaN deviation for rows that do not vary
+    """
+    windows = matrix.shape[1]
+    means = np.asarray(matrix.sum(axis = 1)).ravel() / windows
+    squares = np.asarray(matrix.multiply(matrix).sum(axis = 1)).ravel() / windows
+    stds = np.sqrt(np.maximum(squares - means * means, 0))
+    stds[stds == 0] = np.nan
+    return means, stds
+
+def correlations(matrix, rows, counts = None, row_moments = None):
+    """ Dense Pearson correlations across the windows between the given rows
+    of a sparse templates x windows matrix and every template, from one
+    sparse product. NaN for templates whose count does not vary. counts is
+    the transposed matrix in CSR and row_moments the moments of its rows,
+    both computed when not given.
+    """
+    if counts is None:
+        counts = matrix.T.tocsr()
+    means, stds = moments(matrix) if row_moments is None else row_moments
+    products = (matrix[rows] @ counts).toarray()
+    products /= matrix.shape[1]
+    products -= means[rows, None] * means[None, :]
+    products /= stds[rows, None] * stds[None, :]
+    return np.clip(products, -1, 1, out = products)
+
+def top_correlations(matrix, events, k = DEFAULT_TOP_K, rows = None, memory_budget = DEFAULT_MEMORY_BUDGET):
+    """ The k templates most correlated with each of the given rows, all
+    templates by default, as a frame of EventId, CorrelatedEventId,
+    Correlation and Rank. Rows are processed in blocks sized to the memory
+    budget, so memory does not grow with the number of templates squared.
+    """
+    start_time = datetime.now()
+    templates = matrix.shape[0]
+    rows = np.arange(templates) if rows is None else np.asarray(rows, dtype = np.int64)
+    matrix = scipy.sparse.csr_matrix(matrix, dtype = np.float64)
+    counts = matrix.T.tocsr()
+    row_moments = moments(matrix)
+    k = min(k, templates - 1)
+    size = block_rows(templates, memory_budget)
+    sources = []
+    targets = []
+    values = []
+    for block_start in range(0, len(rows) if k > 0 else 0, size):
+        block = rows[block_start:block_start + size]
+        block_correlations = correlations(matrix, block, counts, row_moments)
+        block_correlations[np.arange(len(block)), block] = np.nan
+        block_correlations = np.nan_to_num(block_correlations, nan = -np.inf)
+        top = np.argpartition(-block_correlations, k - 1, axis = 1)[:, :k]
+        top_values = np.take_along_axis(block_correlations, top, axis = 1)
+        order = np.argsort(-top_values, axis = 1, kind = 'stable')
+        top = np.take_along_axis(top, order, axis = 1)
+        top_values = np.take_along_axis(top_values, order, axis = 1)
+        found = np.isfinite(top_values)
+        sources.append(np.repeat(block, k).reshape(len(block), k)[found])
+        targets.append(top[found])
+        values.append(top_values[found])
+    sources = np.concatenate(sources) if sources else np.zeros(0, dtype = np.int64)
+    targets = np.concatenate(targets) if targets else np.zeros(0, dtype = np.int64)
+    values = np.concatenate(values) if values else np.zeros(0)
+    events = np.asarray(events, dtype = object)
+    result = pd.DataFrame({
+        'EventId': events[sources],
+        'CorrelatedEventId': events[targets],
+        'Correlation': values
+    })
+    result['Rank'] = result.groupby('EventId', sort = False).cumcount() + 1
+    print(f"Correlated {len(rows)} of {templates} templates over {matrix.shape[1]} windows. "
+          f"[Time taken: {datetime.now() - start_time}]")
+    return result
+
+def top_correlated_errors(window_counts, k = DEFAULT_TOP_K, memory_budget = DEFAULT_MEMORY_BUDGET):
+    """ The k templates whose error lines are most correlated with those of
+    every template with error lines
+    """
+    matrix = count_matrix(window_counts, errors = True)
+    rows = np.flatnonzero(np.diff(matrix.indptr) > 0)
+    return top_correlations(matrix, window_counts.events, k, rows, memory_budget)
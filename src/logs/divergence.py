@@ -0,0 +1,165 @@
+import math
+import numpy as np
+import pandas as pd
+from windows import to_timestamps, NAT, DEFAULT_WINDOW_SIZE, DEFAULT_ERROR_LEVELS
+
+DEFAULT_SMOOTHING = 1.0  # count added to every template of both distributions
+
+class DivergenceTracker:
+    """ Kullback-Leibler divergence of the template distribution of every
+    window from the baseline of all windows before it, or of the windows
+    before freeze was called. Both distributions are smoothed by adding
+    smoothing to the count of every template seen so far. The templates a
+    window did not touch all have the same smoothed window probability, so
+    their part of the sum follows from the running sum of the log smoothed
+    baseline counts: scoring a window and merging it into the baseline take
+    time in the number of templates it touched, not of all templates.
+    """
+    def __init__(self, smoothing = DEFAULT_SMOOTHING):
+        self.smoothing = smoothing
+        # template -> count of the baseline and of the current window
+        self.baseline = dict()
+        self.window = dict()
+        self.baseline_total = 0
+        self.window_total = 0
+        # sum of log(count + smoothing) of the baseline over all templates
+        self.log_sum = 0.0
+        self.frozen = False
+
+    def vocabulary(self):
+        return len(self.baseline)
+
+    def add(self, template, count = 1):
+        if template not in self.baseline:
+            self.baseline[template] = 0
+            self.log_sum += math.log(self.smoothing)
+        self.window[template] = self.window.get(template, 0) + count
+        self.window_total += count
+
+    def score(self):
+        """ Smoothed KL divergence of the current window from the baseline,
+        NaN for a window without lines
+        """
+        if self.window_total == 0:
+            return float('nan')
+        alpha = self.smoothing
+        vocabulary = len(self.baseline)
+        window_norm = math.log(self.window_total + alpha * vocabulary)
+        baseline_norm = math.log(self.baseline_total + alpha * vocabulary)
+        divergence = 0.0
+        touched_log_sum = 0.0
+        baseline = self.baseline
+        for template, count in self.window.items():
+            baseline_log = math.log(baseline[template] + alpha)
+            touched_log_sum += baseline_log
+            log_q = math.log(count + alpha) - window_norm
+            divergence += math.exp(log_q) * (log_q - baseline_log + baseline_norm)
+        untouched = vocabulary - len(self.window)
+        if untouched > 0:
+            log_q0 = math.log(alpha) - window_norm
+            untouched_log_p = (self.log_sum - touched_log_sum) - untouched * baseline_norm
+            divergence += math.exp(log_q0) * (untouched * log_q0 - untouched_log_p)
+        return max(divergence, 0.0)
+
+    def close(self):
+        """ Scores the current window, merges it into the baseline unless the
+        baseline is frozen and starts the next window
+        """
+        divergence = self.score()
+        lines = self.window_total
+        if not self.frozen:
+            alpha = self.smoothing
+            for template, count in self.window.items():
+                old = self.baseline[template]
+                self.log_sum += math.log(old + count + alpha) - math.log(old + alpha)
+                self.baseline[template] = old + count
+            self.baseline_total += self.window_total
+        self.window = dict()
+        self.window_total = 0
+        return lines, divergence
+
+    def freeze(self):
+        """ Keeps the current baseline for all following windows
+        """
+        self.frozen = True
+
+class WindowDivergence:
+    """ Divergence per tumbling window of size milliseconds of all templates
+    and of the templates with an error level, as tracked by the clusters of
+    Drain and Spell. A line counts as an error by the level its cluster has
+    when it is added, a later template change can change the cluster's level.
+    Lines are expected in time order, a line of a window before the current
+    one is counted in the current one.
+    """
+    def __init__(self, size = DEFAULT_WINDOW_SIZE, error_levels = DEFAULT_ERROR_LEVELS,
+                 smoothing = DEFAULT_SMOOTHING):
+        self.size = size
+        self.error_levels = set(error_levels)
+        self.general = DivergenceTracker(smoothing)
+        self.error = DivergenceTracker(smoothing)
+        self.current = None
+        # (window start, lines, divergence, error lines, error divergence) of the closed windows
+        self.scores = []
+
+    def add(self, cluster, timestamp):
+        """ Counts a line of the cluster, closing the current window when the
+        line belongs to a later one
+        """
+        if timestamp == NAT:
+            return
+        window = timestamp // self.size
+        if self.current is None:
+            self.current = window
+        elif window > self.current:
+            self.close()
+            self.current = window
+        self.general.add(cluster)
+        if cluster.level in self.error_levels:
+            self.error.add(cluster)
+
+    def add_lines(self, clusters, timestamps):
+        for cluster, timestamp in zip(clusters, timestamps.tolist()):
+            self.add(cluster, timestamp)
+
+    def close(self):
+        if self.current is None:
+            return
+        lines, divergence = self.general.close()
+        error_lines, error_divergence = self.error.close()
+        self.scores.append((self.current * self.size, lines, divergence, error_lines, error_divergence))
+        self.current = None
+
+    def freeze(self):
+        self.general.freeze()
+        self.error.freeze()
+
+    def to_frame(self):
+        frame = pd.DataFrame(self.scores, columns = ['WindowStart', 'Lines', 'Divergence', 'ErrorLines',
+                                                     'ErrorDivergence'])
+        frame['WindowStart'] = pd.to_datetime(frame['WindowStart'], unit = 'ms')
+        return frame
+
+    def __str__(self):
+        if len(self.scores) == 0:
+            return "no window closed"
+        start, lines, divergence, error_lines, error_divergence = self.scores[-1]
+        return (f"window {pd.to_datetime(start, unit = 'ms')}: {lines} lines, divergence {divergence:.4f}, "
+                f"{error_lines} error lines, error divergence {error_divergence:.4f}")
+
+def window_divergence(df_log, logClustL, size = DEFAULT_WINDOW_SIZE, error_levels = DEFAULT_ERROR_LEVELS,
+                      smoothing = DEFAULT_SMOOTHING):
+    """ WindowDivergence of the parsed lines of df_log, fed in time order
+    """
+    clusters = np.empty(df_log.shape[0], dtype = object)
+    clustered = np.zeros(df_log.shape[0], dtype = bool)
+    for logClust in logClustL:
+        if len(logClust.logIDL) > 0:
+            clusters[np.asarray(logClust.logIDL) - 1] = logClust
+            clustered[np.asarray(logClust.logIDL) - 1] = True
+    timestamps = to_timestamps(df_log['Date'], df_log['Time'])
+    order = np.argsort(timestamps, kind = 'stable')
+    order = order[clustered[order]]
+    divergence = WindowDivergence(size, error_levels, smoothing)
+    divergence.add_lines(clusters[order], timestamps[order])
+    divergence.close()
+    return divergence
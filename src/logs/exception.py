@@ -1,15 +1,114 @@
 import re
+import csv
 import itertools
+import hashlib
+from functools import lru_cache
 from Spell import Spell
 from Drain import Drain
 
+DEFAULT_TOP_FRAMES = 5  # stack frames of a trace that are part of its fingerprint
+DEFAULT_WRITE_BATCH = 256  # new exceptions buffered before they are appended to the file
+FINGERPRINT_SIZE = 16  # bytes of a fingerprint
+IDENTITY_CACHE_SIZE = 1 << 16  # distinct trace lines whose identities are memoized
+
+# lines of a trace that identify its exceptions
+IDENTITY_PATTERNS = [
+    r"(java|scala|org)[\.a-zA-Z0-9_:$@]*Exception: [\.a-zA-Z0-9_:$@\s]*",
+    r"Caused by\: [\.a-zA-Z0-9_$@]*(\:[\.a-zA-Z0-9_$@\=\[\],<>\s]*)?",
+    r"Caused by\: [\.a-zA-Z0-9_$@]*\: [\.a-zA-Z0-9_$@\=\[\],<>\s\:]+.*"
+]
+IDENTITY_REGEXPS = [re.compile(f'^{p}$') for p in IDENTITY_PATTERNS]
+# rejects the lines matching none of the patterns, most of a trace, in one search
+IDENTITY_REGEX = re.compile('^(?:' + '|'.join(IDENTITY_PATTERNS) + ')$')
+SPLIT_REGEX = re.compile(r'[\W_]')
+LINE_NUMBER_REGEX = re.compile(r':\d+\)')
+
+class ParserError(Exception):
+    pass
+
+@lru_cache(maxsize = IDENTITY_CACHE_SIZE)
+def split_identity(line):
+    return tuple(sp for sp in SPLIT_REGEX.split(line) if sp != "")
+
+@lru_cache(maxsize = IDENTITY_CACHE_SIZE)
+def line_identities(line):
+    """ The split stripped line once for every identity pattern it matches
+    """
+    if IDENTITY_REGEX.search(line) is None:
+        return ()
+    tokens = split_identity(line)
+    return tuple(tokens for regexp in IDENTITY_REGEXPS if regexp.search(line))
+
+def extract_identities(lines):
+    """ Split identity lines of a trace, its first line if it has none
+    """
+    result = []
+    for line in lines:
+        result.extend(line_identities(line.strip()))
+    if len(result) == 0:
+        result.append(split_identity(lines[0]))
+    return result
+
+def extract_identities_batch(blocks):
+    """ Identities of every trace of a list, the lines shared by the
+    traces are matched once
+    """
+    identities = dict()
+    result = []
+    for lines in blocks:
+        extracted = []
+        for line in lines:
+            line_ids = identities.get(line)
+            if line_ids is None:
+                line_ids = identities[line] = line_identities(line.strip())
+            extracted.extend(line_ids)
+        if len(extracted) == 0:
+            extracted.append(split_identity(lines[0]))
+        result.append(extracted)
+    return result
+
+class ExceptionEntry:
+    """ A distinct exception with the Date and Time of the log lines of the
+    first and the last of its occurrences, None for lines without them
+    """
+    __slots__ = ('fingerprint', 'identities', 'count', 'first_seen', 'last_seen')
+
+    def __init__(self, fingerprint, identities, seen):
+        self.fingerprint = fingerprint
+        self.identities = identities
+        self.count = 1
+        self.first_seen = seen
+        self.last_seen = seen
+
+    def __getstate__(self):
+        return (self.fingerprint, self.identities, self.count, self.first_seen, self.last_seen)
+
+    def __setstate__(self, state):
+        self.fingerprint, self.identities, self.count, self.first_seen, self.last_seen = state
+
 class TextIndex:
-    def __init__(self, extractor = "Drain", output_dir = "./results"):
+    """ Index of the exceptions of the log lines. A trace is identified by the
+    fingerprint of its identity lines and its top frames: a trace seen before
+    is only counted, a new one is clustered by the extractor and, when it
+    starts or changes a cluster, appended to result/exceptions.txt. Entries
+    are buffered and appended write_batch at a time in a single write, so
+    that the entries of sources parsed in parallel do not interleave.
+    Counts are those of the current run: a restored index still knows the
+    traces of the previous runs, but counts them from zero again.
+    """
+    def __init__(self, extractor = "Drain", output_dir = "./results", top_frames = DEFAULT_TOP_FRAMES,
+                 write_batch = DEFAULT_WRITE_BATCH):
+        # fingerprint -> ExceptionEntry
         self.texts = dict()
         self.output_dir = output_dir
         self.extractor = self.newExtractor(extractor)
-        self.exception_file = open('result/exceptions.txt', "a+")
+        self.exception_file = open('result/exceptions.txt', "ab", buffering = 0)
+        self.top_frames = top_frames
+        self.write_batch = write_batch
+        self.pending = []
         self.counter = 0
+        # exceptions added in this run
+        self.added = 0
 
     def newExtractor(self, extractor):
         if extractor == "Drain":
@@ -20,40 +119,129 @@ class TextIndex:
             tau = 0.3
             return Spell.LogParser(outdir = self.output_dir, tau=tau)
         else:
-            raise ParserError(f"Unknown extractor type {self.extractor}")
+            raise ParserError(f"Unknown extractor type {extractor}")
 
     def add(self, log_line):
-        self.counter += 1
+        """ Indexes the exception of the log line, returns its ExceptionEntry
+        """
         text_lines = TextLines(log_line.exception)
+        return self.add_text(text_lines, text_lines.fingerprint(self.top_frames), log_line.seen)
+
+    def add_text(self, text_lines, fingerprint, seen = None):
+        self.counter += 1
+        self.added += 1
+        entry = self.texts.get(fingerprint)
+        if entry is not None:
+            if entry.count == 0:
+                entry.first_seen = seen
+            entry.count += 1
+            entry.last_seen = seen
+            return entry
+        entry = ExceptionEntry(fingerprint, text_lines.identities_str(), seen)
+        self.texts[fingerprint] = entry
         status = self.extractor.add_log(self.counter, text_lines.identities_seq(), "ERROR")
-        if status == "existing":
-            return text_lines.identities_str()
-        self.texts[id] = text_lines
-        # TODO index identities
-        self.exception_file.write("--------\n")
-        self.exception_file.write("id:")
-        self.exception_file.write(text_lines.identities_str())
-        self.exception_file.write("\n")
-        for trace_line in text_lines.lines:
-            self.exception_file.write("  " + trace_line)
-        return id
+        if status != "existing":
+            lines = ["--------\n", "id:", fingerprint.hex(), " ", entry.identities, "\n"]
+            lines.extend("  " + trace_line for trace_line in text_lines.lines)
+            self.pending.append("".join(lines))
+            if len(self.pending) >= self.write_batch:
+                self.flush()
+        return entry
+
+    def add_all(self, log_lines):
+        """ Indexes the exceptions of the log lines in order, the identities
+        of the traces not in the index yet are extracted at once
+        """
+        text_lines = [TextLines(log_line.exception) for log_line in log_lines]
+        fingerprints = [lines.fingerprint(self.top_frames) for lines in text_lines]
+        new = dict()
+        for lines, fingerprint in zip(text_lines, fingerprints):
+            if fingerprint not in self.texts and fingerprint not in new:
+                new[fingerprint] = lines
+        blocks = list(new.values())
+        for lines, identities in zip(blocks, extract_identities_batch([lines.lines for lines in blocks])):
+            lines.set_identities(identities)
+        return [self.add_text(lines, fingerprint, log_line.seen)
+                for lines, fingerprint, log_line in zip(text_lines, fingerprints, log_lines)]
+
+    def entries(self):
+        """ Distinct exceptions of this run, most frequent first and the
+        first indexed first among equally frequent ones
+        """
+        return sorted((entry for entry in self.texts.values() if entry.count > 0), key = lambda entry: -entry.count)
+
+    def write_entries(self, path):
+        """ Writes the distinct exceptions, most frequent first, as a csv file
+        """
+        with open(path, 'w', newline = '') as fout:
+            writer = csv.writer(fout)
+            writer.writerow(['Fingerprint', 'Count', 'FirstSeen', 'LastSeen', 'Identities'])
+            for entry in self.entries():
+                writer.writerow([entry.fingerprint.hex(), entry.count, entry.first_seen, entry.last_seen,
+                                 entry.identities])
+
+    def flush(self):
+        if len(self.pending) > 0:
+            self.exception_file.write("".join(self.pending).encode(errors = 'replace'))
+            self.pending = []
+
+    def get_state(self):
+        """ Exception clusters, distinct exceptions and counter for a checkpoint
+        """
+        return {"counter": self.counter, "extractor": self.extractor.getState(), "texts": self.texts}
+
+    def set_state(self, state):
+        self.counter = state["counter"]
+        self.extractor.setState(state["extractor"])
+        self.texts = state.get("texts", dict())
+        for entry in self.texts.values():
+            entry.count = 0
+            entry.first_seen = None
+            entry.last_seen = None
+
+    def __str__(self):
+        return f"{self.added} exceptions, {sum(entry.count > 0 for entry in self.texts.values())} distinct"
 
     def close(self):
         # self.extractor.printTree(self.extractor.rootNode, 0)
+        self.flush()
         self.exception_file.close()
 
 class TextLines:
     def __init__(self, lines):
         self.lines = lines
-        self.exception_identity_patterns = [\
-            "(java|scala|org)[\.a-zA-Z0-9_:$@]*Exception: [\.a-zA-Z0-9_:$@\s]*",\
-            "Caused by\: [\.a-zA-Z0-9_$@]*(\:[\.a-zA-Z0-9_$@\=\[\],<>\s]*)?",\
-            "Caused by\: [\.a-zA-Z0-9_$@]*\: [\.a-zA-Z0-9_$@\=\[\],<>\s\:]+.*"\
-        ]
-        self.identities = self.extract_identities(self.exception_identity_patterns, self.lines)
+        self._identities = None
+
+    @property
+    def identities(self):
+        """ Split identity lines, only extracted for traces not in the index yet
+        """
+        if self._identities is None:
+            self._identities = extract_identities(self.lines)
+        return self._identities
 
-    def _split(self, line):
-        return [sp for sp in re.split(r'[\W_]', line) if sp != ""]
+    def set_identities(self, identities):
+        self._identities = identities
+
+    def fingerprint(self, top_frames = DEFAULT_TOP_FRAMES):
+        """ Digest of the identity lines and the first top_frames stack frames
+        of every exception in the trace, without line numbers, so the same
+        trace thrown from an edited build still matches
+        """
+        digest = hashlib.blake2b(digest_size = FINGERPRINT_SIZE)
+        frames = 0
+        for line in self.lines:
+            line = line.strip()
+            if line.startswith('at '):
+                if frames < top_frames:
+                    digest.update(LINE_NUMBER_REGEX.sub(')', line).encode(errors = 'replace'))
+                    digest.update(b'\n')
+                frames += 1
+            elif line.startswith('Caused by') or frames == 0:
+                digest.update(line.encode(errors = 'replace'))
+                digest.update(b'\n')
+                frames = 0
+        return digest.digest()
 
     def identities_str(self):
         return "[" + ",".join(self.identities_seq()) + "]"
@@ -61,18 +249,6 @@ class TextLines:
     def identities_seq(self):
         return list(itertools.chain.from_iterable(self.identities))
 
-    def extract_identities(self, patterns, lines):
-        regexps = [re.compile(f'^{p}$') for p in patterns]
-        result = []
-        for line in lines:
-            line = line.strip()
-            for regexp in regexps:
-                if regexp.search(line):
-                    result.append(self._split(line))
-        if len(result) == 0:
-            result.append(self._split(lines[0]))
-        return result
-
     def equals(self, other):
         if len(other.lines) != len(self.lines):
             return False
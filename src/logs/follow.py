@@ -0,0 +1,277 @@
+import re
+import os
+import time
+from preprocessor import Preprocessor, JavaExceptionPreprocessor, LogAssembler, LogFSM, DEFAULT_CHUNK_SIZE
+from exception import TextIndex, ParserError
+from windows import to_timestamps
+
+DEFAULT_POLL_INTERVAL = 1.0  # seconds between polls of files without new data
+DEFAULT_IDLE_TIMEOUT = 2.0  # seconds without new data after which a buffered record is complete
+TAIL_SCAN_BYTES = 1 << 16  # bytes searched backwards for a line start when starting at the end
+
+class FollowStats:
+    """ Throughput and latency of a LogFollower. Latency is the time from
+    reading a record's first line to clustering it, this includes the time
+    a trace stays buffered; noticing new data adds up to one poll interval.
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self.lines = 0
+        self.records = 0
+        self.exceptions = 0
+        self.new_templates = 0
+        self.latency_total = 0.0
+        self.latency_count = 0
+        self.latency_max = 0.0
+        self.last_latency = 0.0
+
+    def add_latency(self, latency):
+        self.latency_total += latency
+        self.latency_count += 1
+        self.latency_max = max(self.latency_max, latency)
+        self.last_latency = latency
+
+    def lines_per_sec(self):
+        elapsed = time.time() - self.start_time
+        return self.lines / elapsed if elapsed > 0 else 0.0
+
+    def mean_latency(self):
+        return self.latency_total / self.latency_count if self.latency_count > 0 else 0.0
+
+    def __str__(self):
+        return (f"{self.lines} lines, {self.lines_per_sec():.1f} lines/sec, {self.records} records, "
+                f"{self.exceptions} exceptions, {self.new_templates} new templates, "
+                f"latency mean {self.mean_latency():.3f}s max {self.latency_max:.3f}s")
+
+class FollowedFile:
+    """ An open file being followed with the bytes and records not complete yet
+    """
+    def __init__(self, path, fsm, offset):
+        self.path = path
+        self.fin = open(path, 'rb')
+        self.fin.seek(offset)
+        self.offset = offset
+        # bytes after the last newline read
+        self.partial = b''
+        self.assembler = LogAssembler(fsm)
+        # read time of the oldest line buffered in the assembler
+        self.pending_since = None
+        self.last_data = time.time()
+
+    def read_lines(self, chunk_size):
+        """ Complete lines appended since the last read, at most about chunk_size bytes
+        """
+        data = self.fin.read(chunk_size)
+        if not data:
+            return []
+        self.offset += len(data)
+        self.last_data = time.time()
+        data = self.partial + data
+        end = data.rfind(b'\n') + 1
+        self.partial = data[end:]
+        return self._split(data[:end])
+
+    def take_partial(self):
+        """ The unterminated last line, once the file is known to be complete
+        """
+        lines = self._split(self.partial + b'\n') if self.partial else []
+        self.partial = b''
+        return lines
+
+    def rewind(self):
+        self.fin.seek(0)
+        self.offset = 0
+        self.partial = b''
+
+    def close(self):
+        self.fin.close()
+
+    def _split(self, data):
+        text = data.decode(errors = 'replace').replace('\r\n', '\n')
+        return [line + '\n' for line in text.split('\n')[:-1] if len(line.strip()) > 0]
+
+class LogFollower:
+    """ Tails the files of a directory that match logfile_pattern and clusters
+    appended lines with extractor.add_log within seconds. Files are tracked by
+    device and inode: a rotated file is read to its end through its open handle
+    before it is let go, a new file is read from its start and a truncated one
+    again from the start. Lines go through the LogAssembler, so a record and its
+    stack trace are only clustered once a following log line shows they are
+    complete, or once no data arrived for idle_timeout seconds. A
+    WindowDivergence given as divergence gets every clustered line with its
+    cluster and the timestamp of its Date and Time headers. The clusters keep
+    no line ids, occurrences counts the lines of every cluster instead, so
+    memory grows with the templates and not with the lines followed.
+    """
+    def __init__(self, directory, logfile_pattern, logformat, extractor, text_index = None, rex = None,
+                 from_start = False, poll_interval = DEFAULT_POLL_INTERVAL, idle_timeout = DEFAULT_IDLE_TIMEOUT,
+                 chunk_size = DEFAULT_CHUNK_SIZE, divergence = None):
+        self.directory = directory
+        self.file_regex = re.compile(f'^{logfile_pattern}$')
+        self.extractor = extractor
+        self.own_index = text_index is None
+        self.text_index = TextIndex() if text_index is None else text_index
+        self.preprocessor = Preprocessor(directory, logformat, [] if rex is None else rex,
+                                         text_index = self.text_index)
+        self.headers, self.splitter = self.preprocessor.generate_logformat_splitter(logformat)
+        self.content = self.headers.index('Content')
+        self.level = self.headers.index('Level')
+        self.divergence = divergence
+        if divergence is not None:
+            if 'Date' not in self.headers or 'Time' not in self.headers:
+                raise ParserError(f"Window divergence needs the Date and Time headers in {logformat}")
+            self.date = self.headers.index('Date')
+            self.time = self.headers.index('Time')
+        self.exception_regex = JavaExceptionPreprocessor(self.splitter).exception_regex
+        self.from_start = from_start
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.chunk_size = chunk_size
+        self.files = dict()
+        self.started = False
+        self.linecount = 0
+        # cluster -> lines clustered into it
+        self.occurrences = dict()
+        self.stats = FollowStats()
+
+    def matching_files(self):
+        return [os.path.join(self.directory, f) for f in sorted(os.listdir(self.directory))
+                if self.file_regex.search(f)]
+
+    def poll(self):
+        """ Reads and clusters what was appended since the last poll,
+        returns the number of lines read
+        """
+        seen = set()
+        for path in self.matching_files():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            key = (stat.st_dev, stat.st_ino)
+            seen.add(key)
+            followed = self.files.get(key)
+            if followed is None:
+                start = 0 if self.started or self.from_start else self._tail_start(path, stat.st_size)
+                self.files[key] = FollowedFile(path, self._new_fsm(), start)
+            elif stat.st_size < followed.offset:
+                print(f"File truncated: {path}")
+                self._finish(followed)
+                followed.rewind()
+
+        for key in [key for key in self.files if key not in seen]:
+            # renamed out of the pattern or removed, its handle still reads the rest
+            followed = self.files.pop(key)
+            self._drain(followed)
+            self._finish(followed)
+            followed.close()
+
+        count = 0
+        now = time.time()
+        for followed in self.files.values():
+            lines = followed.read_lines(self.chunk_size)
+            if lines:
+                count += len(lines)
+                self._feed(followed, lines)
+            elif followed.pending_since is not None and now - followed.last_data >= self.idle_timeout:
+                self._finish(followed)
+        # new exceptions reach exceptions.txt every poll instead of in batches
+        self.text_index.flush()
+        self.started = True
+        return count
+
+    def run(self, duration = None, report_interval = 10.0):
+        """ Polls until duration seconds passed, forever by default,
+        printing the stats every report_interval seconds
+        """
+        end_time = None if duration is None else time.time() + duration
+        next_report = time.time() + report_interval
+        try:
+            while end_time is None or time.time() < end_time:
+                if self.poll() == 0:
+                    time.sleep(self.poll_interval)
+                if time.time() >= next_report:
+                    print(f"Following: {self.stats}")
+                    next_report = time.time() + report_interval
+        except KeyboardInterrupt:
+            pass
+        self.close()
+
+    def close(self):
+        for followed in self.files.values():
+            self._finish(followed)
+            followed.close()
+        self.files = dict()
+        if self.divergence is not None:
+            self.divergence.close()
+        if self.own_index:
+            self.text_index.close()
+
+    def _new_fsm(self):
+        return LogFSM(self.splitter, self.exception_regex)
+
+    def _tail_start(self, path, size):
+        """ Offset of the line start at or before the end of the file
+        """
+        with open(path, 'rb') as fin:
+            start = max(0, size - TAIL_SCAN_BYTES)
+            fin.seek(start)
+            data = fin.read(size - start)
+        return start + data.rfind(b'\n') + 1
+
+    def _feed(self, followed, lines):
+        read_time = time.time()
+        self.stats.lines += len(lines)
+        since = followed.pending_since if followed.pending_since is not None else read_time
+        records = followed.assembler.feed(lines)
+        if records:
+            self._cluster(records, since)
+            since = read_time
+        followed.pending_since = since if followed.assembler.pending else None
+
+    def _drain(self, followed):
+        while True:
+            offset = followed.offset
+            lines = followed.read_lines(self.chunk_size)
+            if lines:
+                self._feed(followed, lines)
+            if followed.offset == offset:
+                break
+        lines = followed.take_partial()
+        if lines:
+            self._feed(followed, lines)
+
+    def _finish(self, followed):
+        """ Clusters the buffered record, no more lines are expected for it
+        """
+        since = followed.pending_since
+        records = followed.assembler.flush()
+        if records:
+            self._cluster(records, since if since is not None else time.time())
+        followed.pending_since = None
+
+    def _cluster(self, records, since):
+        clustered = []
+        for line in records:
+            if line.exception is not None and len(line.exception) != 0:
+                self.stats.exceptions += 1
+            message = self.preprocessor._to_message(line, self.splitter, self.text_index)
+            if message is None:
+                continue
+            self.linecount += 1
+            content = self.preprocessor.preprocess(message[self.content])
+            status = self.extractor.add_log(self.linecount, self.extractor.tokenize(content),
+                                            message[self.level].strip())
+            cluster = self.extractor.lastCluster
+            # add_log appended the line id last, followed lines are only counted
+            cluster.logIDL.pop()
+            self.occurrences[cluster] = self.occurrences.get(cluster, 0) + 1
+            self.stats.records += 1
+            if status == "new":
+                self.stats.new_templates += 1
+            if self.divergence is not None:
+                clustered.append((cluster, message[self.date], message[self.time]))
+        if len(clustered) > 0:
+            clusters, dates, times = zip(*clustered)
+            self.divergence.add_lines(clusters, to_timestamps(dates, times))
+        self.stats.add_latency(time.time() - since)
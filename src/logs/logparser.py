@@ -1,49 +1,242 @@
 import sys
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
 from Spell import Spell
 from Drain import Drain
 from preprocessor import Preprocessor
-from os import listdir
-from os.path import isfile, join
-
-class ParserError(Exception):
-    pass
+from exception import TextIndex, ParserError
+from checkpoint import SourceCheckpoint
+from cache import DEFAULT_CACHE_SIZE
+from follow import LogFollower, DEFAULT_POLL_INTERVAL
+from divergence import WindowDivergence
+from baseline import BaselineIndex, cluster_rows, exception_rows
+from registry import TemplateRegistry
+from os import listdir, makedirs
+from os.path import isfile, join, getsize, exists
 
 class LogParser:
-    def __init__(self, root_dir, output_dir, config, extractor = "Drain"):
+    def __init__(self, root_dir, output_dir, config, extractor = "Drain", workers = 1, source_workers = 1,
+                 memory_budget = None, parse_workers = 1, checkpoint_dir = None, cache_size = DEFAULT_CACHE_SIZE,
+                 output_format = "csv", baseline_dir = None):
         self.config = config
         self.root_dir = root_dir
         self.output_dir = output_dir
         self.extractor = extractor
+        self.workers = workers
+        # sources parsed concurrently and the bound on the summed input size
+        # (in bytes) of the sources that are in flight at the same time
+        self.source_workers = source_workers
+        self.memory_budget = memory_budget
+        # processes Drain parses the message lengths of a source in
+        self.parse_workers = parse_workers
+        # directory the parser state of every source is saved to and resumed from
+        self.checkpoint_dir = checkpoint_dir
+        # distinct messages the extractors remember the matched cluster of
+        self.cache_size = cache_size
+        # "csv" or "parquet" for the columnar output with a template dictionary
+        self.output_format = output_format
+        # directory with the baseline index of every source the runs are compared to
+        self.baseline_dir = baseline_dir
+        # templates and exceptions of all parsed sources, each stored once
+        self.registry = TemplateRegistry()
 
     def newExtractor(self):
         if self.extractor == "Drain":
             st         = 0.5  # Similarity threshold
             depth      = 4  # Depth of all leaf nodes
-            return Drain.LogParser(outdir = self.output_dir, depth=depth, st=st)
+            return Drain.LogParser(outdir = self.output_dir, depth=depth, st=st, workers=self.parse_workers,
+                                   cacheSize=self.cache_size)
         elif self.extractor == "Spell":
             tau = 0.3
-            return Spell.LogParser(outdir = self.output_dir, tau=tau)
+            return Spell.LogParser(outdir = self.output_dir, tau=tau, cacheSize=self.cache_size)
         else:
             raise ParserError(f"Unknown extractor type {self.extractor}")
 
+    def source_files(self, path_config):
+        """ Sorted paths of the files of a logical source that match its logfile_pattern
+        """
+        full_path = join(self.root_dir, path_config["input_dir"])
+        logfile_pattern = path_config["logfile_pattern"]
+        regex = re.compile(f'^{logfile_pattern}$')
+        files = [f for f in listdir(full_path) if isfile(join(full_path, f))]
+        return [join(full_path, file) for file in sorted(files) if regex.search(file)]
 
     def load_data(self):
+        # sources in the order of the config, whatever order they are parsed in
+        for path_config in self.config["logs"]:
+            self.registry.source(path_config["name"])
+        if self.source_workers <= 1 or len(self.config["logs"]) <= 1:
+            for path_config in self.config["logs"]:
+                self.parse_source(path_config, self.source_files(path_config), self.workers)
+        else:
+            self.parse_sources_concurrently()
+        self.write_registry()
+
+    def write_registry(self):
+        """ Writes the templates and unique errors of the sources parsed in
+        this run, the files of the previous run stay when nothing was parsed
+        """
+        if len(self.registry.parsed) == 0:
+            print("No source parsed, registry not written.")
+            return
+        if not exists(self.output_dir):
+            makedirs(self.output_dir)
+        self.registry.to_frame('template').to_csv(join(self.output_dir, 'registry_templates.csv'), index = False)
+        self.registry.unique_errors().to_csv(join(self.output_dir, 'unique_errors.csv'), index = False)
+        print(f"Registry: {self.registry}")
+
+    def follow(self, duration = None, from_start = False, poll_interval = DEFAULT_POLL_INTERVAL, report_interval = 10.0,
+               divergence_window = None):
+        """ Follows the files of every source and clusters appended lines as
+        they are written, until duration seconds passed or forever by default.
+        With a divergence_window in milliseconds every source also scores the
+        divergence of its windows.
+        """
+        followers = []
         for path_config in self.config["logs"]:
-            logical_name = path_config["name"]
-            print(f"Parsing {logical_name}...")
             full_path = join(self.root_dir, path_config["input_dir"])
-            logfile_pattern = path_config["logfile_pattern"]
-            regex = re.compile(f'^{logfile_pattern}$')
-            files = [f for f in listdir(full_path) if isfile(join(full_path, f))]
-            preprocessor = Preprocessor(directory = full_path, logformat = path_config["logformat"], rex=[])
-            for file in files:
-                match = regex.search(file)
-                if regex.search(file):
-                    full_file_path = join(full_path, file)
-                    print(f"Preprocessing {full_file_path}...")
-                    preprocessor.load_data(full_file_path)
+            divergence = WindowDivergence(divergence_window) if divergence_window is not None else None
+            followers.append(LogFollower(full_path, path_config["logfile_pattern"], path_config["logformat"],
+                                         self.newExtractor(), rex = path_config.get("rex", []),
+                                         from_start = from_start, divergence = divergence))
+        start_time = datetime.now()
+        next_report = start_time
+        try:
+            while duration is None or (datetime.now() - start_time).total_seconds() < duration:
+                if sum(follower.poll() for follower in followers) == 0:
+                    time.sleep(poll_interval)
+                if datetime.now() >= next_report:
+                    for path_config, follower in zip(self.config["logs"], followers):
+                        print(f"Following {path_config['name']}: {follower.stats}")
+                        if follower.divergence is not None:
+                            print(f"Divergence of {path_config['name']}: {follower.divergence}")
+                    next_report = datetime.now() + timedelta(seconds = report_interval)
+        except KeyboardInterrupt:
+            pass
+        for follower in followers:
+            follower.close()
+        return followers
+
+    def parse_source(self, path_config, file_paths, workers):
+        logical_name = path_config["name"]
+        print(f"Parsing {logical_name}...")
+        full_path = join(self.root_dir, path_config["input_dir"])
+        extractor = self.newExtractor()
+        checkpoint = None
+        # one index for all files, so a trace repeated in every file is clustered once
+        text_index = TextIndex()
+        offsets = None
+        complete = ()
+        if self.checkpoint_dir is not None:
+            checkpoint = SourceCheckpoint(join(self.checkpoint_dir, logical_name))
+            checkpoint.restore(extractor, text_index)
+            offsets = checkpoint.start_offsets(file_paths)
+            complete = checkpoint.complete_files(file_paths)
+        try:
+            preprocessor = Preprocessor(directory = full_path, logformat = path_config["logformat"],
+                                        rex = path_config.get("rex", []),
+                                        text_index = text_index)
+            if offsets is not None:
+                unchanged = [path for path in file_paths if offsets[path] >= getsize(path)]
+                preprocessor.offsets.update((path, offsets[path]) for path in unchanged)
+                preprocessor.read_ends.update((path, offsets[path]) for path in unchanged)
+                file_paths = [path for path in file_paths if offsets[path] < getsize(path)]
+                if len(file_paths) == 0:
+                    print(f"No new data in {logical_name}.")
+                    return
+            print(f"Preprocessing {len(file_paths)} files...")
+            start_time = datetime.now()
+            preprocessor.load_files(file_paths, workers = workers, offsets = offsets, complete = complete)
+            print(f"Preprocessing done. [Time taken: {datetime.now() - start_time}]")
+            if preprocessor.masker is not None:
+                print(f"Masked variables: {preprocessor.masker}")
+            print(f"Exceptions: {text_index}")
+            if preprocessor.columns.count == 0:
+                # only blank lines, an unterminated last line or an unfinished record were appended
+                print(f"No new records in {logical_name}.")
+                if checkpoint is not None:
+                    checkpoint.save(extractor, text_index, preprocessor.offsets, preprocessor.read_ends)
+                return
             df_log = preprocessor.get_log_dataframe()
-            extractor = self.newExtractor()
             extractor.parse(df_log)
-            extractor.outputResult(df_log, extractor.logCluL, path_config["name"])
+            if self.output_format == "parquet":
+                extractor.outputColumnar(df_log, extractor.logCluL, logical_name)
+            elif self.output_format == "csv":
+                extractor.outputResult(df_log, extractor.logCluL, logical_name)
+            else:
+                raise ParserError(f"Unknown output format {self.output_format}")
+            text_index.write_entries(join(self.output_dir, logical_name + '_exceptions.csv'))
+            self.registry.add_source(logical_name, extractor.logCluL, extractor.tokens, text_index)
+            if self.baseline_dir is not None:
+                self.compare_baseline(logical_name, extractor, text_index)
+            if checkpoint is not None:
+                checkpoint.save(extractor, text_index, preprocessor.offsets, preprocessor.read_ends)
+        finally:
+            text_index.close()
+
+    def compare_baseline(self, logical_name, extractor, text_index):
+        """ Compares the templates and exceptions of the source with its
+        baseline and writes the differences to <name>_baseline_diff.csv
+        """
+        baseline_path = join(self.baseline_dir, logical_name)
+        if not exists(baseline_path):
+            print(f"No baseline for {logical_name}.")
+            return
+        start_time = datetime.now()
+        report = BaselineIndex.load(baseline_path).compare(cluster_rows(extractor.logCluL, extractor.tokens),
+                                                           exception_rows(text_index))
+        report.to_frame().to_csv(join(self.output_dir, logical_name + '_baseline_diff.csv'), index = False)
+        print(f"Baseline of {logical_name}: {report}. [Time taken: {datetime.now() - start_time}]")
+
+    def parse_sources_concurrently(self):
+        """ Parses the logical sources in a process pool, the largest first.
+        A source is started only while the input size of the running sources
+        stays within memory_budget, one source at a time always runs.
+        Every source writes its output as soon as it is parsed.
+        """
+        pending = []
+        for path_config in self.config["logs"]:
+            file_paths = self.source_files(path_config)
+            pending.append((sum(getsize(path) for path in file_paths), path_config, file_paths))
+        pending.sort(key = lambda source: source[0], reverse = True)
+        running = dict()
+        in_flight = 0
+        start_time = datetime.now()
+        with ProcessPoolExecutor(max_workers = self.source_workers) as executor:
+            while pending or running:
+                while pending and len(running) < self.source_workers:
+                    index = self._next_source(pending, in_flight, len(running))
+                    if index is None:
+                        break
+                    size, path_config, file_paths = pending.pop(index)
+                    # file level pools are not nested into the source workers
+                    future = executor.submit(_parse_source, self.root_dir, self.output_dir, self.extractor, path_config, file_paths,
+                                             self.checkpoint_dir, self.cache_size, self.output_format,
+                                             self.baseline_dir)
+                    running[future] = (size, path_config["name"])
+                    in_flight += size
+                done, _ = wait(running, return_when = FIRST_COMPLETED)
+                for future in done:
+                    size, logical_name = running.pop(future)
+                    in_flight -= size
+                    self.registry.merge(future.result())
+                    print(f"Source {logical_name} done. [Time elapsed: {datetime.now() - start_time}]")
+
+    def _next_source(self, pending, in_flight, running):
+        """ Index of the largest pending source that fits into the memory budget
+        """
+        for index, (size, _, _) in enumerate(pending):
+            if running == 0 or self.memory_budget is None or in_flight + size <= self.memory_budget:
+                return index
+        return None
+
+def _parse_source(root_dir, output_dir, extractor, path_config, file_paths, checkpoint_dir, cache_size,
+                  output_format, baseline_dir):
+    """ Entry point of a source worker process, returns the registry of the source
+    """
+    parser = LogParser(root_dir, output_dir, {"logs": [path_config]}, extractor, checkpoint_dir = checkpoint_dir,
+                       cache_size = cache_size, output_format = output_format, baseline_dir = baseline_dir)
+    parser.parse_source(path_config, file_paths, 1)
+    return parser.registry
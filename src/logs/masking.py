@@ -0,0 +1,106 @@
+import re
+from collections import Counter
+
+# variables commonly masked before clustering, in the order they are tried
+COMMON_MASKS = [
+    r'(?:\d{1,3}\.){3}\d{1,3}(?::\d+)?',  # IPv4 address with an optional port
+    r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}',  # UUID
+    r'0[xX][0-9a-fA-F]+',  # hex number
+    r'(?<![\w.])[-+]?\d+(?:\.\d+)?(?![\w.])'  # decimal number
+]
+# characters every match of COMMON_MASKS starts with, the hint of a Masker of them
+COMMON_MASKS_HINT = r'0-9a-fA-F+\-'
+
+# inline flags at the start of a pattern apply to the whole alternation
+_GLOBAL_FLAGS = re.compile(r'^\(\?([aiLmsux]+)\)')
+# unescaped numbered or named backreference, or group conditional
+_BACKREFERENCE = re.compile(r'(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?P=|\(\?\()')
+
+def scoped(pattern):
+    """ The pattern with its leading inline flags limited to a group, so it
+    can be part of an alternation
+    """
+    match = _GLOBAL_FLAGS.match(pattern)
+    if match is None:
+        return '(?:' + pattern + ')'
+    return '(?' + match.group(1) + ':' + pattern[match.end():] + ')'
+
+def joinable(pattern):
+    """ False for a pattern whose groups break in an alternation: group
+    names must be unique and backreferences count the groups of the patterns
+    before it
+    """
+    return len(re.compile(pattern).groupindex) == 0 and _BACKREFERENCE.search(pattern) is None
+
+class Masker:
+    """ Replaces the variables matched by any of the patterns in a single
+    pass. The patterns are joined into one alternation of groups, at every
+    position the first pattern that matches wins. counts holds the matches
+    per pattern. hint optionally lists, as the contents of a character
+    class, every character a match can start with, e.g. '0-9+-'. It becomes
+    a lookahead that lets the scan skip other positions without trying
+    every alternative. Patterns with named groups or backreferences cannot
+    be joined, with one of them the patterns are substituted one after the
+    other instead.
+    """
+    def __init__(self, patterns, replacement = '*', hint = None):
+        self.patterns = list(patterns)
+        self.replacement = replacement
+        self.counts = [0] * len(self.patterns)
+        lookahead = '(?=[' + hint + '])' if hint else ''
+        self.weight = 1
+        if not all(joinable(pattern) for pattern in self.patterns):
+            self.regex = None
+            self.regexes = [re.compile(lookahead + scoped(pattern)) for pattern in self.patterns]
+            return
+        # group number of a pattern in the alternation -> pattern index
+        self.group_patterns = dict()
+        parts = []
+        group = 1
+        for index, pattern in enumerate(self.patterns):
+            self.group_patterns[group] = index
+            group += 1 + re.compile(pattern).groups
+            parts.append('(' + scoped(pattern) + ')')
+        self.regex = re.compile(lookahead + '(?:' + '|'.join(parts) + ')')
+
+    def mask(self, text):
+        if not self.patterns:
+            return text
+        self.weight = 1
+        return self._sub(text)
+
+    def mask_column(self, values):
+        """ mask of every value of a column. Every distinct value is masked once,
+        its matches are counted as often as it occurs.
+        """
+        if not self.patterns:
+            return list(values)
+        masked = dict()
+        for value, count in Counter(values).items():
+            self.weight = count
+            masked[value] = self._sub(value)
+        self.weight = 1
+        return [masked[value] for value in values]
+
+    def pattern_counts(self):
+        return list(zip(self.patterns, self.counts))
+
+    def add_counts(self, counts):
+        for index, count in enumerate(counts):
+            self.counts[index] += count
+
+    def _sub(self, text):
+        if self.regex is not None:
+            return self.regex.sub(self._replace, text)
+        replacement = self.replacement.replace('\\', r'\\')
+        for index, regex in enumerate(self.regexes):
+            text, count = regex.subn(replacement, text)
+            self.counts[index] += count * self.weight
+        return text
+
+    def _replace(self, match):
+        self.counts[self.group_patterns[match.lastindex]] += self.weight
+        return self.replacement
+
+    def __str__(self):
+        return ', '.join(f'{pattern} : {count}' for pattern, count in self.pattern_counts())
@@ -0,0 +1,87 @@
+import os
+import hashlib
+import numpy as np
+
+DEFAULT_ROW_GROUP_SIZE = 1 << 20  # lines per parquet row group
+DEFAULT_COMPRESSION = 'zstd'
+
+def _parquet():
+    """ pyarrow is only needed for the columnar output
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("The columnar output needs pyarrow, install it with pip install loginsight[columnar]")
+    return pyarrow, pyarrow.parquet
+
+def event_indexes(line_count, logClustL):
+    """ Position in logClustL of the cluster of every line, -1 for lines
+    that are in no cluster
+    """
+    event_idx = np.full(line_count, -1, dtype=np.int32)
+    for index, logClust in enumerate(logClustL):
+        if len(logClust.logIDL) > 0:
+            event_idx[np.asarray(logClust.logIDL) - 1] = index
+    return event_idx
+
+def write_columnar(save_path, logname, df_log, logClustL, tokens, row_group_size = DEFAULT_ROW_GROUP_SIZE,
+                   compression = DEFAULT_COMPRESSION):
+    """ Writes <logname>_templates.parquet, one row per cluster with lines
+    with its EventIdx, EventId, Level, EventTemplate and Occurrences, and
+    <logname>_structured.parquet, the columns of df_log plus the EventIdx of
+    every line, whose Level is the one of its cluster as in the csv output.
+    Templates are stored once instead of on every line, the structured file is
+    written one row group at a time.
+    """
+    pa, pq = _parquet()
+    if not os.path.exists(save_path):
+        os.makedirs(save_path)
+
+    # clusters restored from a checkpoint may have no lines in this run
+    logClustL = [logClust for logClust in logClustL if len(logClust.logIDL) > 0]
+    event_ids = []
+    levels = []
+    templates = []
+    occurrences = []
+    for logClust in logClustL:
+        template_str = ' '.join(tokens.decode(logClust.logTemplate))
+        event_ids.append(hashlib.md5(template_str.encode('utf-8')).hexdigest()[0:8])
+        levels.append(logClust.level)
+        templates.append(template_str)
+        occurrences.append(len(logClust.logIDL))
+    templates_table = pa.table({
+        'EventIdx': pa.array(np.arange(len(logClustL), dtype=np.int32)),
+        'EventId': pa.array(event_ids, type=pa.string()),
+        'Level': pa.array(levels, type=pa.string()).dictionary_encode(),
+        'EventTemplate': pa.array(templates, type=pa.string()),
+        'Occurrences': pa.array(occurrences, type=pa.int64())
+    })
+    pq.write_table(templates_table, os.path.join(save_path, logname + '_templates.parquet'),
+                   compression=compression)
+
+    line_count = df_log.shape[0]
+    event_idx = event_indexes(line_count, logClustL)
+    level_names = sorted(set(levels))
+    level_codes = {level: code for code, level in enumerate(level_names)}
+    level_idx = np.asarray([level_codes[level] for level in levels] + [-1], dtype=np.int32)[event_idx]
+    level_dictionary = pa.array(level_names, type=pa.string())
+    writer = None
+    try:
+        for start in range(0, max(line_count, 1), row_group_size):
+            rows = df_log.iloc[start:start + row_group_size]
+            table = pa.Table.from_pandas(rows, preserve_index=False)
+            indices = level_idx[start:start + row_group_size]
+            level = pa.DictionaryArray.from_arrays(pa.array(indices, mask=indices < 0), level_dictionary)
+            if 'Level' in table.column_names:
+                table = table.set_column(table.column_names.index('Level'), 'Level', level)
+            else:
+                table = table.append_column('Level', level)
+            table = table.append_column('EventIdx', pa.array(event_idx[start:start + row_group_size]))
+            if writer is None:
+                writer = pq.ParquetWriter(os.path.join(save_path, logname + '_structured.parquet'),
+                                          table.schema, compression=compression)
+            writer.write_table(table, row_group_size=row_group_size)
+    finally:
+        if writer is not None:
+            writer.close()
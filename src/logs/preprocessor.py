@@ -3,15 +3,35 @@ import os
 import sys
 import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 import hashlib
+from collections import deque
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from exception import TextIndex, TextLines
+from masking import Masker
+
+DEFAULT_CHUNK_SIZE = 1 << 20  # bytes read per chunk in streaming mode
+DEFAULT_BATCH_SIZE = 10000  # parsed records per yielded batch
+DEFAULT_MAX_PENDING = 100000  # lines held back before forcing a block out
+
+# low cardinality headers stored as categoricals
+CATEGORICAL_COLUMNS = ('Level', 'Component')
+# headers of the line an exception was seen on that are kept with the exception
+SEEN_HEADERS = ('Date', 'Time')
+
+# line classes computed by LogFSM.classify
+LOG_LINE = 1
+EXCEPTION_LINE = 2
 
 class LogLine:
     def __init__(self, line, unclassified = None, exception = []):
         self.logline = line
         self.exception = exception
         self.unclassified = unclassified
+        # Date and Time of the line, set for the lines with an exception
+        self.seen = None
 
     def is_processed(self):
         return self.logline is not None
@@ -19,17 +39,36 @@ class LogLine:
 class LogFSM:
     def __init__(self, line_regex, exception_regexps):
         self.line_regex = line_regex
-        self.exception_regexps = [re.compile(f'^{regex}$') for regex in exception_regexps]
-        self.non_ascii_regex = r'[^\x00-\x7F]+'
+        self.exception_regex = re.compile('^(?:' + '|'.join(exception_regexps) + ')$')
+        self.non_ascii_regex = re.compile(r'[^\x00-\x7F]+')
+
+    def classify(self, lines):
+        """ Computes the class of every line once. The log line regex is
+        only tried on lines that are not exception lines, the FSM does not
+        need it elsewhere apart from the head of a record.
+        """
+        classes = array('B')
+        for line in lines:
+            classes.append(self.classify_line(line))
+        return classes
+
+    def classify_line(self, line):
+        line = line.strip()
+        if self.exception_regex.search(line):
+            return EXCEPTION_LINE
+        if self.line_regex.search(line):
+            return LOG_LINE
+        return 0
 
-    def process(self, i, lines):
+    def process(self, i, lines, classes):
         length = len(lines)
-        line = re.sub(self.non_ascii_regex, '<NASCII>', lines[i])
-        next_line = re.sub(self.non_ascii_regex, '<NASCII>', lines[i + 1] if i + 1 < length else "")
+        line = self.non_ascii_regex.sub('<NASCII>', lines[i])
+        next_cls = classes[i + 1] if i + 1 < length else 0
 
-        is_logline = self._is_log_line(line)
-        is_next_logline = self._is_log_line(next_line)
-        is_next_exception = self._is_exception_line(next_line)
+        is_logline = classes[i] & LOG_LINE or \
+            (classes[i] & EXCEPTION_LINE and self.line_regex.search(line.strip()))
+        is_next_logline = next_cls & LOG_LINE
+        is_next_exception = next_cls & EXCEPTION_LINE
 
         logline_followed_by_exception = is_logline and is_next_exception
         logline_followed_by_maybe_exception = is_logline and not is_next_exception and not is_next_logline
@@ -38,10 +77,10 @@ class LogFSM:
         unclassified_line = not is_logline and is_next_logline
 
         if logline_followed_by_exception:
-            has_exceptions, exception_lines, last_idx = self._scan_maybe_exception(lines, i + 1)
+            has_exceptions, exception_lines, last_idx = self._scan_maybe_exception(lines, classes, i + 1)
             return last_idx + 1, LogLine(line.strip(), None, exception_lines)
         if logline_followed_by_maybe_exception:
-            has_exceptions, exception_lines, last_idx = self._scan_maybe_exception(lines, i + 1)
+            has_exceptions, exception_lines, last_idx = self._scan_maybe_exception(lines, classes, i + 1)
             if has_exceptions:
                 return last_idx + 1, LogLine(line.strip(), None, exception_lines)
             else:
@@ -49,10 +88,10 @@ class LogFSM:
         elif is_logline:
             return i + 1, LogLine(line.strip())
         elif text_followed_by_exception:
-            has_exceptions, exception_lines, last_idx = self._scan_maybe_exception(lines, i + 1)
+            has_exceptions, exception_lines, last_idx = self._scan_maybe_exception(lines, classes, i + 1)
             return last_idx + 1, LogLine(None, line.strip(), exception_lines)
         elif unclassified_lines:
-            has_exceptions, exception_lines, last_idx = self._scan_maybe_exception(lines, i + 1)
+            has_exceptions, exception_lines, last_idx = self._scan_maybe_exception(lines, classes, i + 1)
             return last_idx + 1, LogLine(None, line, exception_lines)
         elif unclassified_line:
             return i + 1, LogLine(None, line, None)
@@ -61,48 +100,72 @@ class LogFSM:
 
         return i + 1, None
 
-    def _is_log_line(self, line):
-        return self.line_regex.search(line.strip())
-
-    def _is_exception_line(self, line):
-        for regex in self.exception_regexps:
-            match = regex.search(line.strip())
-            if match:
-                return True
-        return False
+    def is_boundary(self, cls):
+        """ A log line that no exception scan can absorb, so every
+        record that precedes it is complete
+        """
+        return cls == LOG_LINE
 
-    def _scan_exception(self, lines, current_idx):
-        exception_lines = []
+    def _scan_exception(self, lines, classes, current_idx):
         length = len(lines)
         i = current_idx
-        while i < length:
-            line = lines[i]
-            if self._is_exception_line(line):
-                exception_lines.append(line)
-            else:
-                i -= 1
-                break
+        while i < length and classes[i] & EXCEPTION_LINE:
             i += 1
-        return exception_lines, i
+        return lines[current_idx:i], i - 1
 
-    def _scan_maybe_exception(self, lines, current_idx):
-        exception_lines = []
+    def _scan_maybe_exception(self, lines, classes, current_idx):
         length = len(lines)
         i = current_idx
         has_exceptions = False
         while i < length:
-            line = lines[i]
-            if self._is_exception_line(line):
-                has_exceptions |= True
-                exception_lines.append(line)
-            elif not self._is_log_line(line):
-                exception_lines.append(line)
-            else:
-                i -= 1
+            cls = classes[i]
+            if cls & EXCEPTION_LINE:
+                has_exceptions = True
+            elif cls & LOG_LINE:
                 break
             i += 1
-        return has_exceptions, exception_lines, i
+        return has_exceptions, lines[current_idx:i], i - 1
+
+
+class LogAssembler:
+    """ Feeds chunks of lines through LogFSM, carrying the trailing
+    (possibly unfinished) record and its exception block to the next chunk
+    """
+    def __init__(self, fsm, max_pending = DEFAULT_MAX_PENDING):
+        self.fsm = fsm
+        self.max_pending = max_pending
+        self.pending = []
+        self.pending_classes = array('B')
 
+    def feed(self, lines):
+        classes = self.pending_classes + self.fsm.classify(lines)
+        lines = self.pending + lines
+        stop = self._last_boundary(classes)
+        if stop == 0 and len(lines) > self.max_pending:
+            stop = len(lines) - 1
+        return self._process(lines, classes, stop)
+
+    def flush(self):
+        return self._process(self.pending, self.pending_classes, len(self.pending))
+
+    def _last_boundary(self, classes):
+        i = len(classes) - 1
+        while i > 0:
+            if self.fsm.is_boundary(classes[i]):
+                return i
+            i -= 1
+        return 0
+
+    def _process(self, lines, classes, stop):
+        result = []
+        i = 0
+        while i < stop:
+            i, line = self.fsm.process(i, lines, classes)
+            if line is not None:
+                result.append(line)
+        self.pending = lines[i:]
+        self.pending_classes = classes[i:]
+        return result
 
 class JavaExceptionPreprocessor:
     def __init__(self, line_regex):
@@ -123,73 +186,414 @@ class JavaExceptionPreprocessor:
 
     def preprocess(self, lines):
         fsm = LogFSM(self.line_regex, self.exception_regex)
+        classes = fsm.classify(lines)
         result = []
         i = 0
         while i < len(lines):
-            i, line = fsm.process(i, lines)
+            i, line = fsm.process(i, lines, classes)
             if line is not None:
                 result.append(line)
         return result
 
+    def preprocess_chunks(self, chunks):
+        """ Streaming variant of preprocess, yields LogLine objects while
+        holding at most one chunk plus the pending record in memory
+        """
+        assembler = LogAssembler(LogFSM(self.line_regex, self.exception_regex))
+        for lines in chunks:
+            for line in assembler.feed(lines):
+                yield line
+        for line in assembler.flush():
+            yield line
+
+class ExceptionBuffer:
+    """ Stands in for TextIndex in worker processes, keeping the lines with
+    exceptions so that the parent indexes them in file order
+    """
+    def __init__(self):
+        self.lines = []
+
+    def add(self, log_line):
+        self.lines.append(log_line)
+
+    def close(self):
+        pass
+
+class LogformatSplitter:
+    """ Splits a line into the header fields of a logformat like the regex
+    of Preprocessor.generate_logformat_regex, without its backtracking. Leading
+    fields separated by whitespace are cut with str.split, the remaining
+    separators are searched for left to right. This gives the fields of the
+    regex's first match attempt; lines on which that attempt fails and
+    logformats the splitter cannot follow go to the regex.
+    """
+    def __init__(self, logformat, headers, regex):
+        self.headers = headers
+        self.regex = regex
+        self.seen_fields = [headers.index(header) for header in SEEN_HEADERS if header in headers]
+        self.compiled = False
+        fragments = [re.sub(' +', r'\\s+', fragment) for fragment in re.split(r'(<[^<>]+>)', logformat)[0::2]]
+        prefix, separators, suffix = fragments[0], fragments[1:-1], fragments[-1]
+        # a trailing literal ends the last field at the end of the line, and
+        # alternations or groups change the meaning of the whole regex
+        if len(headers) == 0 or suffix != '' or any(char in fragment for fragment in fragments for char in '|()^$'):
+            return
+        self.whitespace = 0
+        while self.whitespace < len(separators) and separators[self.whitespace] == r'\s+':
+            self.whitespace += 1
+        try:
+            self.prefix = re.compile(prefix) if prefix != '' else None
+            self.separators = [re.compile(separator) for separator in separators[self.whitespace:]]
+        except re.error:
+            # a fragment like '[' is only valid as part of the whole regex
+            return
+        self.compiled = True
+
+    def seen(self, fields):
+        """ Date and Time of the header values of a line, None without them
+        """
+        if fields is None or len(self.seen_fields) == 0:
+            return None
+        return ' '.join(fields[index] for index in self.seen_fields)
+
+    def split(self, line):
+        """ Header values of the line or None if it does not match the logformat
+        """
+        fields = self._split(line) if self.compiled else None
+        if fields is None:
+            match = self.regex.search(line)
+            if match is None:
+                return None
+            fields = [match.group(header) for header in self.headers]
+        return fields
+
+    def search(self, line):
+        """ Truthy for a line that matches the logformat, like the regex's search
+        """
+        return self.split(line)
+
+    def _split(self, line):
+        if '\n' in line:
+            return None
+        if self.prefix is not None:
+            match = self.prefix.match(line)
+            if match is None:
+                return None
+            line = line[match.end():]
+        if self.whitespace > 0:
+            if line[:1].isspace():
+                return None
+            fields = line.split(None, self.whitespace)
+            if len(fields) <= self.whitespace:
+                return None
+            line = fields.pop()
+        else:
+            fields = []
+        pos = 0
+        for separator in self.separators:
+            match = separator.search(line, pos)
+            if match is None:
+                return None
+            fields.append(line[pos:match.start()])
+            pos = match.end()
+        fields.append(line[pos:])
+        return fields
+
+class ColumnAccumulator:
+    """ Collects the messages of all files as column buffers and builds
+    the DataFrame once, instead of concatenating a frame per file. The
+    buffers are released when the frame is built, messages appended later
+    are built into a frame of their own that is concatenated to it.
+    """
+    def __init__(self):
+        self.headers = None
+        self.columns = None
+        self.count = 0
+        self.frame = None
+
+    def append(self, log_messages, headers):
+        if self.headers is None:
+            self.headers = list(headers)
+            self.columns = [[] for _ in headers]
+        for column, values in zip(self.columns, zip(*log_messages)):
+            column.extend(values)
+        self.count += len(log_messages)
+
+    def append_columns(self, columns, count, headers):
+        """ Appends the column buffers of another accumulator
+        """
+        if self.headers is None:
+            self.headers = list(headers)
+            self.columns = [[] for _ in headers]
+        for column, values in zip(self.columns, columns):
+            column.extend(values)
+        self.count += count
+
+    def to_frame(self, headers = None):
+        """ The frame of the appended messages, with the given headers as its
+        columns while none were appended
+        """
+        if self.headers is None and headers is not None:
+            self.headers = list(headers)
+            self.columns = [[] for _ in headers]
+        built = 0 if self.frame is None else self.frame.shape[0]
+        if self.frame is not None and built == self.count:
+            return self.frame
+        data = {'LineId': np.arange(built + 1, self.count + 1)}
+        for header, column in zip(self.headers or [], self.columns or []):
+            if header in CATEGORICAL_COLUMNS:
+                data[header] = pd.Categorical(column)
+            else:
+                data[header] = column
+        chunk = pd.DataFrame(data)
+        self.columns = [[] for _ in self.headers or []]
+        if self.frame is None:
+            self.frame = chunk
+        else:
+            frame = pd.concat([self.frame, chunk], ignore_index = True)
+            for header in self.headers:
+                if header in CATEGORICAL_COLUMNS:
+                    frame[header] = union_categoricals([self.frame[header], chunk[header]])
+            self.frame = frame
+        return self.frame
+
+def preprocess_file(directory, logformat, rex, logname, offset = None, complete = False):
+    """ Preprocesses one file in a worker process of Preprocessor.load_files
+    """
+    preprocessor = Preprocessor(directory, logformat, rex)
+    exceptions = ExceptionBuffer()
+    columns = ColumnAccumulator()
+    for batch in preprocessor.iter_batches(logname, text_index = exceptions, offset = offset, complete = complete):
+        columns.append(batch, preprocessor.headers)
+    return (preprocessor.headers, columns.columns or [], columns.count, exceptions.lines, preprocessor.offsets,
+            preprocessor.read_ends, preprocessor.mask_counts())
+
 class Preprocessor:
-    def __init__(self, directory, logformat, rex):
+    def __init__(self, directory, logformat, rex, text_index = None):
         self.path = directory
         self.logformat = logformat
         self.rex = rex
+        # masks the variables matched by rex in the Content field
+        self.masker = Masker(rex) if len(rex) > 0 else None
         self.logdf = None
+        self.columns = ColumnAccumulator()
+        self.headers = None
+        self.linecount = 0
+        # exception index shared by all files, by default every file gets its own
+        self.text_index = text_index
+        # file path -> byte offset the next read from an offset starts at
+        self.offsets = dict()
+        # file path -> byte offset after the last line read from an offset
+        self.read_ends = dict()
+
+    def load_data(self, logname, offset = None, complete = False):
+        """ Appends the messages of the file to the column buffers batch by
+        batch, only a batch of parsed messages is held at a time
+        """
+        for batch in self.iter_batches(logname, offset = offset, complete = complete):
+            self._append_dataframe(batch, self.headers)
+
+    def load_files(self, lognames, workers = 1, offsets = None, complete = ()):
+        """ Loads the files in the given order. With several workers the files
+        are preprocessed concurrently in a process pool, their results are still
+        appended in the given order so line ids do not depend on the scheduling.
+        offsets optionally maps the files to the byte they are read from,
+        complete lists the files read from an offset that are not written anymore.
+        """
+        if offsets is None:
+            offsets = dict()
+        if workers <= 1:
+            for logname in lognames:
+                self.load_data(logname, offsets.get(logname), logname in complete)
+            return
+
+        count = len(lognames)
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            results = executor.map(preprocess_file, [self.path] * count, [self.logformat] * count,
+                                   [self.rex] * count, lognames, [offsets.get(logname) for logname in lognames],
+                                   [logname in complete for logname in lognames])
+            for headers, columns, count, exception_lines, file_offsets, read_ends, mask_counts in results:
+                text_index = self.text_index if self.text_index is not None else TextIndex()
+                text_index.add_all(exception_lines)
+                if text_index is not self.text_index:
+                    text_index.close()
+                self.offsets.update(file_offsets)
+                self.read_ends.update(read_ends)
+                if self.masker is not None:
+                    self.masker.add_counts(mask_counts)
+                self.headers = headers
+                self.columns.append_columns(columns, count, headers)
+
+    def read_chunks(self, file_path, chunk_size = DEFAULT_CHUNK_SIZE, offset = None):
+        """ Reads the file in chunks of roughly chunk_size bytes,
+        dropping blank lines
+        """
+        if offset is not None:
+            yield from self.read_chunks_from(file_path, offset, chunk_size)
+            return
+        with open(file_path, 'r') as fin:
+            while True:
+                lines = fin.readlines(chunk_size)
+                if not lines:
+                    break
+                yield [line for line in lines if len(line.strip()) > 0]
+
+    def read_chunks_from(self, file_path, offset, chunk_size = DEFAULT_CHUNK_SIZE):
+        """ Reads the file from a byte offset in chunks like read_chunks. An
+        unterminated last line is still being written and is left for the next
+        read, self.offsets[file_path] is the byte after the last line read.
+        """
+        for lines, _ in self._read_lines_from(file_path, offset, chunk_size):
+            yield lines
 
-    def load_data(self, logname):
+    def _read_lines_from(self, file_path, offset, chunk_size):
+        """ Chunks of read_chunks_from with the byte offset every line starts at
+        """
+        self.offsets[file_path] = offset
+        self.read_ends[file_path] = offset
+        with open(file_path, 'rb') as fin:
+            fin.seek(offset)
+            while True:
+                raw_lines = fin.readlines(chunk_size)
+                if raw_lines and not raw_lines[-1].endswith(b'\n'):
+                    raw_lines.pop()
+                if not raw_lines:
+                    break
+                lines = []
+                starts = []
+                for raw_line in raw_lines:
+                    line = raw_line.decode().replace('\r\n', '\n')
+                    if len(line.strip()) > 0:
+                        lines.append(line)
+                        starts.append(offset)
+                    offset += len(raw_line)
+                self.offsets[file_path] = offset
+                self.read_ends[file_path] = offset
+                yield lines, starts
+
+    def _preprocess_from(self, java, file_path, offset, chunk_size, complete):
+        """ preprocess_chunks of the file from a byte offset. Unless the file is
+        complete, its last record can still get exception lines: it is held
+        back and self.offsets[file_path] is the byte it starts at, so that the
+        next read gets the whole record.
+        """
+        assembler = LogAssembler(LogFSM(java.line_regex, java.exception_regex))
+        # start offsets of the lines pending in the assembler
+        starts = deque()
+        for lines, line_starts in self._read_lines_from(file_path, offset, chunk_size):
+            starts.extend(line_starts)
+            for line in assembler.feed(lines):
+                yield line
+            while len(starts) > len(assembler.pending):
+                starts.popleft()
+        if complete:
+            for line in assembler.flush():
+                yield line
+        elif len(starts) > 0:
+            self.offsets[file_path] = starts[0]
+
+    def iter_batches(self, logname, chunk_size = DEFAULT_CHUNK_SIZE, batch_size = DEFAULT_BATCH_SIZE,
+                     text_index = None, offset = None, complete = False):
+        """ Streams the file and yields lists of at most batch_size parsed
+        messages, each message being the list of header values. Exceptions go
+        to text_index, the preprocessor's one or a new TextIndex for the file
+        by default. Reading starts at byte offset if one is given, the last
+        record is then left for the next read unless the file is complete.
+        """
         file_path = os.path.join(self.path, logname)
         print('Parsing file: ' + file_path)
-        lines = []
-        with open(file_path, 'r') as fin:
-            lines = fin.readlines()
-            lines = [line for line in lines if len(line.strip()) > 0]
+        headers, splitter = self.generate_logformat_splitter(self.logformat)
+        self.headers = headers
+        content = headers.index('Content')
+        java = JavaExceptionPreprocessor(splitter)
+        if offset is None:
+            lines = java.preprocess_chunks(self.read_chunks(file_path, chunk_size))
+        else:
+            lines = self._preprocess_from(java, file_path, offset, chunk_size, complete)
+        if text_index is None:
+            text_index = self.text_index
+        own_index = text_index is None
+        if own_index:
+            text_index = TextIndex()
+        try:
+            batch = []
+            for line in lines:
+                message = self._to_message(line, splitter, text_index)
+                if message is None:
+                    continue
+                batch.append(message)
+                if len(batch) >= batch_size:
+                    yield self.mask_batch(batch, content)
+                    batch = []
+            if len(batch) > 0:
+                yield self.mask_batch(batch, content)
+        finally:
+            if own_index:
+                text_index.close()
 
-        headers, regex = self.generate_logformat_regex(self.logformat)
-        preprocessed = JavaExceptionPreprocessor(regex).preprocess(lines)
-        self.log_to_dataframe(preprocessed, regex, headers, self.logformat)
+    def iter_records(self, logname, chunk_size = DEFAULT_CHUNK_SIZE, batch_size = DEFAULT_BATCH_SIZE):
+        """ Streams the file as batches of (LineId, Content, Level) records for
+        the extractors, line ids continue across the files of this preprocessor
+        """
+        for batch in self.iter_batches(logname, chunk_size, batch_size):
+            content = self.headers.index('Content')
+            level = self.headers.index('Level')
+            records = []
+            for message in batch:
+                self.linecount += 1
+                records.append((self.linecount, message[content], message[level]))
+            yield records
 
     def preprocess(self, line):
-        for currentRex in self.rex:
-            line = re.sub(currentRex, '*', line)
-        return line
+        """ Content with the variables matched by rex masked
+        """
+        if self.masker is None:
+            return line
+        return self.masker.mask(line)
+
+    def mask_batch(self, log_messages, content):
+        """ Masks the Content field of a batch of messages in place
+        """
+        if self.masker is None:
+            return log_messages
+        masked = self.masker.mask_column([message[content] for message in log_messages])
+        for message, value in zip(log_messages, masked):
+            message[content] = value
+        return log_messages
+
+    def mask_counts(self):
+        return list(self.masker.counts) if self.masker is not None else []
 
     def log_to_dataframe(self, lines, regex, headers, logformat):
         """ Function to transform log file to dataframe
         """
         log_messages = []
-        linecount = 0
-        text_index = TextIndex()
+        text_index = self.text_index if self.text_index is not None else TextIndex()
+        splitter = LogformatSplitter(logformat, headers, regex)
         for line in lines:
-            if line.exception is not None and len(line.exception) != 0:
-                text_index.add(line)
-
-            if (not line.is_processed()):
-                continue
-
-            line = line.logline
-            line = re.sub(r'[^\x00-\x7F]+', '<NASCII>', line)
-            try:
-                match = regex.search(line.strip())
-                message = [match.group(header) for header in headers]
-
-                log_messages.append(self.preprocess(message))
-                linecount += 1
-            except Exception as e:
-                pass
-        text_index.close()
-        current = pd.DataFrame(log_messages, columns=headers)
-        current.insert(0, 'LineId', None)
-
-        if self.logdf is None:
-            self.logdf = current
-        else:
-            self.logdf = pd.concat([self.logdf, current])
+            message = self._to_message(line, splitter, text_index)
+            if message is not None:
+                log_messages.append(message)
+        if text_index is not self.text_index:
+            text_index.close()
+        self.mask_batch(log_messages, headers.index('Content'))
+        self._append_dataframe(log_messages, headers)
+
+    def _to_message(self, line, splitter, text_index):
+        message = None
+        if line.is_processed():
+            message = splitter.split(re.sub(r'[^\x00-\x7F]+', '<NASCII>', line.logline).strip())
+
+        if line.exception is not None and len(line.exception) != 0:
+            line.seen = splitter.seen(message)
+            text_index.add(line)
+        return message
+
+    def _append_dataframe(self, log_messages, headers):
+        self.columns.append(log_messages, headers)
 
     def get_log_dataframe(self):
-        count = self.logdf.shape[0]
-        self.logdf['LineId'] = [i + 1 for i in range(count)]
+        self.logdf = self.columns.to_frame(self.headers)
         return self.logdf
 
     def generate_logformat_regex(self, logformat):
@@ -200,7 +604,7 @@ class Preprocessor:
         regex = ''
         for k in range(len(splitters)):
             if k % 2 == 0:
-                splitter = re.sub(' +', '\s+', splitters[k])
+                splitter = re.sub(' +', r'\\s+', splitters[k])
                 regex += splitter
             else:
                 header = splitters[k].strip('<').strip('>')
@@ -208,3 +612,10 @@ class Preprocessor:
                 headers.append(header)
         regex = re.compile('^' + regex + '$')
         return headers, regex
+
+    def generate_logformat_splitter(self, logformat):
+        """ Headers and a LogformatSplitter that yields the same fields as
+        the regex of generate_logformat_regex
+        """
+        headers, regex = self.generate_logformat_regex(logformat)
+        return headers, LogformatSplitter(logformat, headers, regex)
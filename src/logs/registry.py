@@ -0,0 +1,161 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from baseline import cluster_rows, exception_rows
+from windows import DEFAULT_ERROR_LEVELS
+
+class TemplateSet:
+    """ Templates, or exceptions, of all sources deduplicated by their stable
+    ID. Every ID is stored once with a dense index, the occurrences per
+    source are kept as parallel arrays of (source, index, count) entries, so
+    memory grows with the distinct IDs and the entries, not with IDs times
+    sources.
+    """
+    def __init__(self):
+        # stable ID -> dense index of the ids, labels and errors
+        self.indexes = dict()
+        self.ids = []
+        self.labels = []
+        self.errors = bytearray()
+        self.sources = np.zeros(0, dtype = np.int32)
+        self.rows = np.zeros(0, dtype = np.int32)
+        self.counts = np.zeros(0, dtype = np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index(self, id, label, error = False):
+        index = self.indexes.get(id)
+        if index is None:
+            index = self.indexes[id] = len(self.ids)
+            self.ids.append(id)
+            self.labels.append(label)
+            self.errors.append(0)
+        if error:
+            self.errors[index] = 1
+        return index
+
+    def add(self, source, rows):
+        """ Replaces the occurrences of source by the (ID, label, count, error)
+        rows, the counts of repeated IDs summed
+        """
+        indexes = [self.index(id, label, error) for id, label, _, error in rows]
+        counts = [count for _, _, count, _ in rows]
+        self.add_indexes(source, np.asarray(indexes, dtype = np.int32), np.asarray(counts, dtype = np.int64))
+
+    def add_indexes(self, source, indexes, counts):
+        rows, inverse = np.unique(indexes, return_inverse = True)
+        counts = np.bincount(inverse, weights = counts, minlength = len(rows)).astype(np.int64)
+        keep = self.sources != source
+        self.sources = np.concatenate([self.sources[keep], np.full(len(rows), source, dtype = np.int32)])
+        self.rows = np.concatenate([self.rows[keep], rows.astype(np.int32)])
+        self.counts = np.concatenate([self.counts[keep], counts])
+
+    def merge(self, other, source_map):
+        """ Adds the entries of another set, its sources mapped to ours by source_map
+        """
+        row_map = np.asarray([self.index(id, label, error) for id, label, error
+                              in zip(other.ids, other.labels, other.errors)], dtype = np.int32)
+        for other_source, source in enumerate(source_map):
+            entries = other.sources == other_source
+            if entries.any():
+                self.add_indexes(source, row_map[other.rows[entries]], other.counts[entries])
+
+    def matrix(self, sources):
+        """ Sparse IDs x sources CSR matrix of the occurrences
+        """
+        return scipy.sparse.csr_matrix((self.counts, (self.rows, self.sources)), shape = (len(self.ids), sources))
+
+    def to_frame(self, source_names):
+        """ Frame of Id, Label, Error, Sources, Occurrences and the SourceNames
+        an ID occurs in, the IDs of most sources and occurrences first
+        """
+        matrix = self.matrix(len(source_names))
+        names = np.asarray(source_names, dtype = object)
+        frame = pd.DataFrame({
+            'Id': self.ids,
+            'Label': self.labels,
+            'Error': np.frombuffer(bytes(self.errors), dtype = np.uint8).astype(bool),
+            'Sources': np.diff(matrix.indptr),
+            'Occurrences': np.asarray(matrix.sum(axis = 1)).ravel().astype(np.int64),
+            'SourceNames': [';'.join(names[matrix.indices[matrix.indptr[row]:matrix.indptr[row + 1]]])
+                            for row in range(len(self.ids))]
+        })
+        return frame.sort_values(['Sources', 'Occurrences', 'Id'], ascending = [False, False, True])
+
+class TemplateRegistry:
+    """ Templates and exception fingerprints shared by all sources. Templates
+    are identified by their md5 EventId, exceptions by their fingerprint, so
+    a template found in several sources is stored once and queries across
+    the sources read the per source counts instead of joining the templates
+    files of every source. Only the sources parsed in a run are registered.
+    """
+    def __init__(self, error_levels = DEFAULT_ERROR_LEVELS):
+        self.error_levels = set(error_levels)
+        # source name -> index of the sources of the entries
+        self.source_indexes = dict()
+        self.source_names = []
+        # names of the sources whose templates were registered
+        self.parsed = set()
+        self.templates = TemplateSet()
+        self.exceptions = TemplateSet()
+
+    def source(self, name):
+        index = self.source_indexes.get(name)
+        if index is None:
+            index = self.source_indexes[name] = len(self.source_names)
+            self.source_names.append(name)
+        return index
+
+    def add_source(self, name, logClustL, tokens, text_index = None):
+        """ Registers the clusters of Drain or Spell and the exceptions of the
+        TextIndex of a parsed source, replacing what it registered before
+        """
+        source = self.source(name)
+        self.parsed.add(name)
+        logClustL = [logClust for logClust in logClustL if len(logClust.logIDL) > 0]
+        self.templates.add(source, [(event_id, template, count, logClust.level in self.error_levels)
+                                    for (event_id, template, count), logClust
+                                    in zip(cluster_rows(logClustL, tokens), logClustL)])
+        if text_index is not None:
+            self.exceptions.add(source, [(fingerprint, identities, count, True)
+                                         for fingerprint, identities, count in exception_rows(text_index)])
+
+    def merge(self, other):
+        """ Adds the sources another registry, e.g. of a worker process, registered
+        """
+        source_map = [self.source(name) for name in other.source_names]
+        self.parsed.update(other.parsed)
+        self.templates.merge(other.templates, source_map)
+        self.exceptions.merge(other.exceptions, source_map)
+
+    def occurrences(self, kind = 'template'):
+        """ Sparse IDs x sources matrix of the occurrences of the templates or exceptions
+        """
+        return self._set(kind).matrix(len(self.source_names))
+
+    def to_frame(self, kind = 'template'):
+        return self._set(kind).to_frame(self.source_names)
+
+    def shared(self, kind = 'template', min_sources = 2):
+        """ Templates or exceptions that occur in at least min_sources sources
+        """
+        frame = self.to_frame(kind)
+        return frame[frame['Sources'] >= min_sources]
+
+    def unique_errors(self):
+        """ Templates with an error level and exceptions, each once across all
+        sources, with the sources they occur in
+        """
+        templates = self.to_frame('template')
+        templates = templates[templates['Error']]
+        frame = pd.concat([templates.assign(Kind = 'template'), self.to_frame('exception').assign(Kind = 'exception')],
+                          ignore_index = True)
+        return frame[['Kind', 'Id', 'Label', 'Sources', 'Occurrences', 'SourceNames']]
+
+    def _set(self, kind):
+        return self.templates if kind == 'template' else self.exceptions
+
+    def __str__(self):
+        return (f"{len(self.templates)} templates, {len(self.exceptions)} exceptions "
+                f"of {len(self.source_names)} sources")
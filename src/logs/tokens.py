@@ -0,0 +1,56 @@
+from array import array
+
+# id of a token that has not been interned
+UNKNOWN_ID = -1
+
+class TokenDictionary:
+    """ Maps tokens to compact integer ids so that templates can be stored
+    and compared as integer arrays. Tokens are turned back into strings only
+    for output.
+    """
+    __slots__ = ('ids', 'tokens')
+
+    def __init__(self):
+        self.ids = dict()
+        self.tokens = []
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def encode_token(self, token):
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = len(self.tokens)
+            self.ids[token] = token_id
+            self.tokens.append(token)
+        return token_id
+
+    def encode(self, seq):
+        """ Ids of the tokens of seq, interning the unknown ones
+        """
+        return array('i', [self.encode_token(token) for token in seq])
+
+    def lookup(self, seq):
+        """ Ids of the tokens of seq without interning, tokens that were never
+        interned get UNKNOWN_ID
+        """
+        ids = self.ids
+        return array('i', [ids.get(token, UNKNOWN_ID) for token in seq])
+
+    def decode_token(self, token_id):
+        return self.tokens[token_id]
+
+    def decode(self, ids):
+        tokens = self.tokens
+        return [tokens[token_id] for token_id in ids]
+
+    def __getstate__(self):
+        # the ids follow from the token order, only the tokens are pickled
+        return self.tokens
+
+    def __setstate__(self, tokens):
+        self.tokens = tokens
+        self.ids = {token: token_id for token_id, token in enumerate(tokens)}
+
+
+shared_tokens = TokenDictionary()
@@ -0,0 +1,269 @@
+import os
+import numpy as np
+import pandas as pd
+
+DEFAULT_DATE_FORMAT = '%Y-%m-%d'
+DEFAULT_TIME_FORMAT = '%H:%M:%S,%f'  # HH:MM:SS,mmm, parsed from its digits
+DEFAULT_WINDOW_SIZE = 60 * 1000  # milliseconds per window
+DEFAULT_ERROR_LEVELS = ('ERROR', 'FATAL', 'SEVERE')
+DEFAULT_CHUNK_LINES = 1 << 20  # lines read per chunk of a structured file
+DEFAULT_MERGE_ENTRIES = 1 << 24  # (window, template) entries kept before the batches are merged
+
+# timestamp of the lines whose date or time does not parse
+NAT = np.iinfo(np.int64).min
+
+def _factorize(values):
+    """ pandas columns are factorized as they are, saving their conversion to objects
+    """
+    if not isinstance(values, (pd.Series, pd.Index)):
+        values = np.asarray(values, dtype = object)
+    codes, uniques = pd.factorize(values)
+    return codes, np.asarray(uniques, dtype = object)
+
+def _time_of_day(times, time_format):
+    """ Milliseconds since midnight of every time, NAT where it does not parse
+    """
+    if time_format == DEFAULT_TIME_FORMAT:
+        values = np.asarray(times, dtype = 'U')
+        if values.dtype.itemsize == 12 * 4 or len(values) == 0:
+            chars = values.view(np.uint32).reshape(len(values), 12)
+            digits = chars.astype(np.int64) - ord('0')
+            digit_cols = [0, 1, 3, 4, 6, 7, 9, 10, 11]
+            valid = ((digits[:, digit_cols] >= 0) & (digits[:, digit_cols] <= 9)).all(axis = 1)
+            valid &= (chars[:, 2] == ord(':')) & (chars[:, 5] == ord(':'))
+            valid &= (chars[:, 8] == ord(',')) | (chars[:, 8] == ord('.'))
+            millis = ((digits[:, 0] * 10 + digits[:, 1]) * 3600000 + (digits[:, 3] * 10 + digits[:, 4]) * 60000
+                      + (digits[:, 6] * 10 + digits[:, 7]) * 1000
+                      + digits[:, 9] * 100 + digits[:, 10] * 10 + digits[:, 11])
+            return np.where(valid, millis, NAT)
+    parsed = pd.to_datetime(pd.Series(times, dtype = object), format = time_format, errors = 'coerce')
+    millis = (parsed - parsed.dt.normalize()).to_numpy().astype('timedelta64[ms]').astype(np.int64)
+    return np.where(parsed.isna().to_numpy(), NAT, millis)
+
+def to_timestamps(dates, times, date_format = DEFAULT_DATE_FORMAT, time_format = DEFAULT_TIME_FORMAT):
+    """ Milliseconds since the epoch of the Date and Time headers of every
+    line, NAT for the lines that do not parse. Every distinct date is parsed
+    once, times of the default format are computed from their digits.
+    """
+    codes, unique_dates = _factorize(dates)
+    days = pd.to_datetime(pd.Series(unique_dates, dtype = object), format = date_format, errors = 'coerce')
+    day_millis = np.where(days.isna().to_numpy(), NAT, days.to_numpy().astype('datetime64[ms]').astype(np.int64))
+    # lines without a date get code -1, which picks the NAT appended last
+    day_millis = np.append(day_millis, NAT)
+    day = day_millis[codes]
+    time_of_day = _time_of_day(times, time_format)
+    return np.where((day == NAT) | (time_of_day == NAT), NAT, day + time_of_day)
+
+def aggregate_keys(keys, counts, error_counts):
+    """ Distinct keys in ascending order with the sums of their counts. Keys
+    in a range not much larger than their number are counted with bincount,
+    others are sorted.
+    """
+    low = int(keys.min()) if len(keys) > 0 else 0
+    span = int(keys.max()) - low + 1 if len(keys) > 0 else 0
+    if span <= 4 * len(keys):
+        sums = np.bincount(keys - low, weights = counts, minlength = span)
+        error_sums = np.bincount(keys - low, weights = error_counts, minlength = span)
+        present = np.flatnonzero(sums)
+        return present + low, sums[present].astype(np.int64), error_sums[present].astype(np.int64)
+    unique_keys, inverse = np.unique(keys, return_inverse = True)
+    return (unique_keys, np.bincount(inverse, weights = counts).astype(np.int64),
+            np.bincount(inverse, weights = error_counts).astype(np.int64))
+
+class WindowCounts:
+    """ Lines per template and window. Window j starts at start + j * step and
+    lasts size milliseconds. The template x window count matrix is kept
+    sparse: entry k counts the counts[k] lines of events[rows[k]] in window
+    windows[k], error_counts[k] of them with an error level. Entries are
+    ordered by window, then row.
+    """
+    def __init__(self, start, size, step, windows_count, events, rows, windows, counts, error_counts):
+        self.start = start
+        self.size = size
+        self.step = step
+        self.windows_count = windows_count
+        self.events = events
+        self.rows = rows
+        self.windows = windows
+        self.counts = counts
+        self.error_counts = error_counts
+
+    def __len__(self):
+        return self.windows_count
+
+    def window_starts(self):
+        return self.start + np.arange(len(self), dtype = np.int64) * self.step
+
+    def totals(self):
+        return np.bincount(self.windows, weights = self.counts, minlength = len(self)).astype(np.int64)
+
+    def errors(self):
+        return np.bincount(self.windows, weights = self.error_counts, minlength = len(self)).astype(np.int64)
+
+    def unique_errors(self):
+        """ Distinct templates with error lines in every window
+        """
+        return np.bincount(self.windows[self.error_counts > 0], minlength = len(self))
+
+    def matrix(self, errors = False):
+        """ Dense events x windows matrix of the line or error counts
+        """
+        matrix = np.zeros((len(self.events), len(self)), dtype = np.int64)
+        matrix[self.rows, self.windows] = self.error_counts if errors else self.counts
+        return matrix
+
+    def silent_windows(self, min_windows = 1):
+        """ (start, end) in milliseconds of every run of at least min_windows
+        consecutive windows without a line
+        """
+        silent = np.concatenate(([False], self.totals() == 0, [False]))
+        edges = np.flatnonzero(silent[1:] != silent[:-1])
+        starts, ends = edges[0::2], edges[1::2]
+        runs = (ends - starts) >= min_windows
+        window_starts = self.start + starts[runs] * self.step
+        window_ends = self.start + (ends[runs] - 1) * self.step + self.size
+        return list(zip(window_starts.tolist(), window_ends.tolist()))
+
+    def sliding(self, size):
+        """ Counts over sliding windows of size milliseconds, a multiple of the
+        window size, that advance by one window. Every entry is added to the
+        size / window size sliding windows that contain its window.
+        """
+        if size % self.size != 0 or self.size != self.step:
+            raise ValueError(f"Sliding windows of {size} ms need tumbling windows of a divisor of it")
+        width = size // self.size
+        windows_count = max(len(self) - width + 1, 0)
+        shifted = self.windows[None, :] - np.arange(width, dtype = np.int64)[:, None]
+        valid = (shifted >= 0) & (shifted < windows_count)
+        windows = shifted[valid]
+        rows = np.broadcast_to(self.rows, shifted.shape)[valid]
+        counts = np.broadcast_to(self.counts, shifted.shape)[valid]
+        error_counts = np.broadcast_to(self.error_counts, shifted.shape)[valid]
+        keys, counts, error_counts = aggregate_keys(windows * max(len(self.events), 1) + rows, counts, error_counts)
+        windows, rows = np.divmod(keys, max(len(self.events), 1))
+        return WindowCounts(self.start, size, self.step, windows_count, self.events, rows, windows, counts,
+                            error_counts)
+
+    def to_frame(self):
+        """ Lines, errors and distinct error templates per window
+        """
+        return pd.DataFrame({
+            'WindowStart': pd.to_datetime(self.window_starts(), unit = 'ms'),
+            'Lines': self.totals(),
+            'Errors': self.errors(),
+            'UniqueErrors': self.unique_errors()
+        })
+
+class WindowAggregator:
+    """ Builds the WindowCounts of tumbling windows of size milliseconds from
+    batches of lines. Windows are aligned to multiples of size since the epoch,
+    so batches can come in any order. The lines of a batch are reduced to
+    their distinct (window, template) entries with one bincount or sort, the
+    entries of all batches are merged the same way once they outgrow
+    merge_entries and when the result is taken.
+    """
+    def __init__(self, size = DEFAULT_WINDOW_SIZE, error_levels = DEFAULT_ERROR_LEVELS,
+                 merge_entries = DEFAULT_MERGE_ENTRIES):
+        self.size = size
+        self.error_levels = list(error_levels)
+        self.merge_entries = merge_entries
+        # EventId -> row of the count matrix
+        self.event_index = dict()
+        self.events = []
+        # (rows, window numbers since the epoch, counts, error counts) of the batches
+        self.entries = []
+        self.entry_count = 0
+        self.lines = 0
+        self.dropped = 0
+
+    def add(self, timestamps, events, levels = None):
+        """ Counts the lines with the given timestamps, EventIds and levels,
+        lines without a timestamp or an event are dropped
+        """
+        timestamps = np.asarray(timestamps, dtype = np.int64)
+        codes, unique_events = _factorize(events)
+        rows = np.array([self._event_row(event) for event in unique_events] + [-1], dtype = np.int64)[codes]
+        valid = (timestamps != NAT) & (rows >= 0)
+        self.lines += len(timestamps)
+        self.dropped += len(timestamps) - int(np.count_nonzero(valid))
+        if levels is None:
+            errors = np.zeros(np.count_nonzero(valid), dtype = np.int64)
+        else:
+            levels = levels if isinstance(levels, pd.Series) else pd.Series(np.asarray(levels, dtype = object))
+            errors = levels.isin(self.error_levels).to_numpy()[valid]
+        windows = timestamps[valid] // self.size
+        if len(windows) == 0:
+            return
+        self._add_entries(rows[valid], windows, np.ones(len(windows), dtype = np.int64), errors.astype(np.int64))
+        if self.entry_count > self.merge_entries:
+            self._merge()
+
+    def add_frame(self, df_log, date_format = DEFAULT_DATE_FORMAT, time_format = DEFAULT_TIME_FORMAT):
+        """ Counts the lines of a structured frame with Date, Time, Level and EventId columns
+        """
+        timestamps = to_timestamps(df_log['Date'], df_log['Time'], date_format, time_format)
+        levels = df_log['Level'] if 'Level' in df_log.columns else None
+        self.add(timestamps, df_log['EventId'], levels)
+
+    def result(self):
+        self._merge()
+        if self.entry_count == 0:
+            empty = np.zeros(0, dtype = np.int64)
+            return WindowCounts(0, self.size, self.size, 0, list(self.events), empty, empty, empty, empty)
+        rows, windows, counts, error_counts = self.entries[0]
+        first = int(windows[0])
+        return WindowCounts(first * self.size, self.size, self.size, int(windows[-1]) - first + 1, list(self.events),
+                            rows, windows - first, counts, error_counts)
+
+    def _event_row(self, event):
+        if not isinstance(event, str):
+            return -1
+        row = self.event_index.get(event)
+        if row is None:
+            row = self.event_index[event] = len(self.events)
+            self.events.append(event)
+        return row
+
+    def _add_entries(self, rows, windows, counts, error_counts):
+        """ Adds the distinct entries of the given ones, ordered by window and row
+        """
+        first = int(windows.min())
+        width = max(len(self.events), 1)
+        keys, counts, error_counts = aggregate_keys((windows - first) * width + rows, counts, error_counts)
+        windows, rows = np.divmod(keys, width)
+        self.entries.append((rows, windows + first, counts, error_counts))
+        self.entry_count += len(keys)
+
+    def _merge(self):
+        if len(self.entries) <= 1:
+            return
+        rows, windows, counts, error_counts = (np.concatenate(column) for column in zip(*self.entries))
+        self.entries = []
+        self.entry_count = 0
+        self._add_entries(rows, windows, counts, error_counts)
+
+def aggregate_structured(path, size = DEFAULT_WINDOW_SIZE, error_levels = DEFAULT_ERROR_LEVELS,
+                         date_format = DEFAULT_DATE_FORMAT, time_format = DEFAULT_TIME_FORMAT,
+                         chunk_lines = DEFAULT_CHUNK_LINES):
+    """ WindowCounts of a <logname>_structured.csv or .parquet written by the
+    parsers, read chunk_lines lines at a time
+    """
+    aggregator = WindowAggregator(size, error_levels)
+    if path.endswith('.parquet'):
+        from output import _parquet
+        pa, pq = _parquet()
+        event_ids = pq.read_table(path.replace('_structured.parquet', '_templates.parquet'),
+                                  columns = ['EventId']).column('EventId').to_numpy(zero_copy_only = False)
+        # lines in no cluster have EventIdx -1, which picks the None appended last
+        event_ids = np.append(event_ids.astype(object), None)
+        for batch in pq.ParquetFile(path).iter_batches(batch_size = chunk_lines,
+                                                       columns = ['Date', 'Time', 'Level', 'EventIdx']):
+            frame = batch.to_pandas()
+            frame['EventId'] = event_ids[frame['EventIdx'].to_numpy()]
+            aggregator.add_frame(frame, date_format, time_format)
+    else:
+        for frame in pd.read_csv(path, usecols = ['Date', 'Time', 'Level', 'EventId'], dtype = str,
+                                 keep_default_na = False, chunksize = chunk_lines):
+            aggregator.add_frame(frame, date_format, time_format)
+    print(f"Aggregated {aggregator.lines} lines of {os.path.basename(path)}, {aggregator.dropped} without a timestamp")
+    return aggregator.result()
@@ -0,0 +1,113 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'logs'))
+
+import pandas as pd
+from logparser import LogParser
+from preprocessor import ColumnAccumulator
+
+LOGFORMAT = "<Date> <Time> <Level> <Component>: <Content>"
+
+class IncrementalRunTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        # TextIndex appends the exception clusters to result/exceptions.txt
+        os.makedirs('result')
+        os.makedirs('logs')
+        self.config = {"logs": [{"name": "app", "input_dir": "logs", "logfile_pattern": r"app\.log",
+                                 "logformat": LOGFORMAT}]}
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def append(self, text):
+        with open(os.path.join('logs', 'app.log'), 'a') as fout:
+            fout.write(text)
+
+    def run_parser(self, output_dir, checkpoint_dir = 'checkpoint', output_format = 'csv'):
+        parser = LogParser(self.directory, output_dir, self.config, checkpoint_dir = checkpoint_dir,
+                           output_format = output_format)
+        parser.load_data()
+        return parser
+
+    def test_partial_line_only(self):
+        self.append("2019-02-01 10:00:00,000 INFO org.app.C0: started worker 1\n"
+                    "2019-02-01 10:00:01,000 INFO org.app.C0: started worker 2\n")
+        self.run_parser('out1')
+        self.append("2019-02-01 10:00:02,000 INFO org.app.C0: started")
+        self.run_parser('out2')
+        self.assertFalse(os.path.exists(os.path.join('out2', 'app_structured.csv')))
+        self.append(" worker 3\n2019-02-01 10:00:03,000 INFO org.app.C0: stopped worker 3\n")
+        self.run_parser('out3')
+        # the last record of a run is held back until the file is not written anymore
+        structured = pd.read_csv(os.path.join('out3', 'app_structured.csv'))
+        self.assertEqual(list(structured['Content']), ['started worker 2', 'started worker 3'])
+
+    def test_trace_cut_across_runs(self):
+        lines = ["2019-02-01 10:00:00,000 INFO org.app.C0: started worker 1\n",
+                 "2019-02-01 10:00:01,000 ERROR org.app.C1: request failed\n",
+                 "java.lang.IllegalStateException: closed\n",
+                 "\tat org.app.Pool.get(Pool.java:12)\n",
+                 "\tat org.app.Handler.run(Handler.java:40)\n",
+                 "\tat java.lang.Thread.run(Thread.java:748)\n",
+                 "2019-02-01 10:00:02,000 INFO org.app.C0: stopped worker 1\n"]
+        self.append("".join(lines[:4]))
+        self.run_parser('out1')
+        self.append("".join(lines[4:]))
+        self.run_parser('out2')
+        # nothing appended, the held back record is complete
+        self.run_parser('out3')
+        runs = ['out1', 'out2', 'out3']
+
+        self.config["logs"][0]["input_dir"] = 'single'
+        os.makedirs('single')
+        with open(os.path.join('single', 'app.log'), 'w') as fout:
+            fout.write("".join(lines))
+        self.run_parser('single', checkpoint_dir = None)
+
+        def contents(output_dir):
+            return list(pd.read_csv(os.path.join(output_dir, 'app_structured.csv'))['Content'])
+
+        def exceptions(output_dir):
+            frame = pd.read_csv(os.path.join(output_dir, 'app_exceptions.csv'))
+            return dict(zip(frame['Fingerprint'], frame['Count']))
+
+        self.assertEqual(sum((contents(run) for run in runs), []), contents('single'))
+        counts = dict()
+        for run in runs:
+            for fingerprint, count in exceptions(run).items():
+                counts[fingerprint] = counts.get(fingerprint, 0) + count
+        self.assertEqual(counts, exceptions('single'))
+        self.assertEqual(len(counts), 1)
+
+    def test_parquet_templates_of_the_run(self):
+        self.append("2019-02-01 10:00:00,000 INFO org.app.C0: started worker 1\n"
+                    "2019-02-01 10:00:01,000 WARN org.app.C1: queue is full\n"
+                    "2019-02-01 10:00:02,000 INFO org.app.C0: started worker 2\n")
+        self.run_parser('out1', output_format = 'parquet')
+        self.append("2019-02-01 10:00:03,000 ERROR org.app.C0: started worker 3\n"
+                    "2019-02-01 10:00:04,000 INFO org.app.C0: started worker 4\n")
+        self.run_parser('out2', output_format = 'parquet')
+        templates = pd.read_parquet(os.path.join('out2', 'app_templates.parquet'))
+        structured = pd.read_parquet(os.path.join('out2', 'app_structured.parquet'))
+        # the queue template of the first run is not part of the second one
+        self.assertEqual(list(templates['EventTemplate']), ['started worker <*>'])
+        self.assertEqual(list(templates['Occurrences']), [2])
+        # lines have the level of their template, as in the csv output
+        self.assertEqual(list(structured['Level'].astype(str)), [templates['Level'].astype(str)[0]] * 2)
+
+class ColumnAccumulatorTest(unittest.TestCase):
+    def test_empty_frame_keeps_headers(self):
+        frame = ColumnAccumulator().to_frame(['Date', 'Level', 'Content'])
+        self.assertEqual(list(frame.columns), ['LineId', 'Date', 'Level', 'Content'])
+        self.assertEqual(frame.shape[0], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,22 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'logs'))
+
+from Drain import Drain
+
+CONTENTS = ['Started', 'a b c', 'Started', 'a b d', '', 'Shutdown', 'x y', 'x z', '   ', 'a b c', 'Started']
+
+def clusters(workers):
+    parser = Drain.LogParser(depth = 4, st = 0.5, workers = workers)
+    parser.parse_columns(list(range(1, len(CONTENTS) + 1)), CONTENTS, ['INFO'] * len(CONTENTS))
+    return [(parser.tokens.decode(logClust.logTemplate), list(logClust.logIDL), logClust.level)
+            for logClust in parser.logCluL]
+
+class DrainParallelTest(unittest.TestCase):
+    def test_parallel_matches_sequential_with_short_messages(self):
+        self.assertEqual(clusters(2), clusters(1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import os
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'logs'))
+
+from masking import Masker, COMMON_MASKS, COMMON_MASKS_HINT
+
+MESSAGES = ['connected to 10.0.0.1:8080 in 25ms',
+            'session 0x1f committed, took 3s',
+            'book keeper aabb retried 2 times',
+            'took 25ms and 3s']
+
+def substituted(patterns, text):
+    for pattern in patterns:
+        text = re.sub(pattern, '*', text)
+    return text
+
+class MaskerTest(unittest.TestCase):
+    def test_common_masks_with_hint(self):
+        masker = Masker(COMMON_MASKS, hint = COMMON_MASKS_HINT)
+        self.assertEqual(masker.mask_column(MESSAGES), [Masker(COMMON_MASKS).mask(message) for message in MESSAGES])
+
+    def test_backreference(self):
+        patterns = [r'\d+ms', r'(\w)\1']
+        masker = Masker(patterns)
+        self.assertEqual([masker.mask(message) for message in MESSAGES],
+                         [substituted(patterns, message) for message in MESSAGES])
+        self.assertEqual(masker.counts, [2, 10])
+
+    def test_shared_group_names(self):
+        patterns = [r'(?P<n>\d+)ms', r'(?P<n>\d+)s']
+        masker = Masker(patterns)
+        self.assertEqual(masker.mask_column(MESSAGES), [substituted(patterns, message) for message in MESSAGES])
+        self.assertEqual(masker.counts, [2, 2])
+
+if __name__ == '__main__':
+    unittest.main()
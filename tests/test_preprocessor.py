@@ -0,0 +1,40 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'logs'))
+
+from preprocessor import Preprocessor
+
+LINES = ['2019-02-01 10:00:00,000 INFO org.app.C0: started worker 1',
+         '2019-02-01 10:00:01,000 [WARN] queue is full',
+         '[10:00:02] [ERROR] request failed',
+         '[10:00:03]  [INFO]  org.app.C1: stopped',
+         'java.lang.IllegalStateException: closed',
+         '']
+
+def regex_fields(headers, regex, line):
+    match = regex.search(line)
+    if match is None:
+        return None
+    return [match.group(header) for header in headers]
+
+class LogformatSplitterTest(unittest.TestCase):
+    def assertSplitsLikeRegex(self, logformat):
+        preprocessor = Preprocessor('', logformat, [])
+        headers, regex = preprocessor.generate_logformat_regex(logformat)
+        _, splitter = preprocessor.generate_logformat_splitter(logformat)
+        for line in LINES:
+            self.assertEqual(splitter.split(line), regex_fields(headers, regex, line), line)
+
+    def test_whitespace_separated(self):
+        self.assertSplitsLikeRegex('<Date> <Time> <Level> <Component>: <Content>')
+
+    def test_bracketed_level(self):
+        self.assertSplitsLikeRegex('<Date> <Time> [<Level>] <Content>')
+
+    def test_bracketed_prefix(self):
+        self.assertSplitsLikeRegex('[<Time>] [<Level>] <Content>')
+
+if __name__ == '__main__':
+    unittest.main()